@@ -0,0 +1,140 @@
+"""
+In-process index for resolving the protein names of a request.
+
+Resolving names used to scan every `TG` node and parse its alias list on
+each request. The index maps symbols, aliases and Ensembl ids of a species
+to their proteins once and is rebuilt only when it is refreshed explicitly
+(`POST /api/admin/refresh`) or the pathway data release changes.
+"""
+
+import json
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+import database
+import neo4j
+import queries
+from term_store import release_version
+from util.stopwatch import Stopwatch
+
+_indexes: Dict[int, "AliasIndex"] = {}
+_lock = threading.Lock()
+
+
+class AliasIndex:
+    """
+    Names of the proteins of one species, all keys are upper case
+
+    - `proteins`: symbol, ENSEMBL_PROTEIN or ENSEMBL_GENE -> protein ids
+    - `aliases`: alias -> symbols of the genes having that alias
+    - `version`: data release the index was built from
+    """
+
+    def __init__(
+        self,
+        species_id: int,
+        proteins: Dict[str, list[str]],
+        aliases: Dict[str, list[str]],
+        version: str,
+    ):
+        self.species_id = species_id
+        self.proteins = proteins
+        self.aliases = aliases
+        self.version = version
+
+    @classmethod
+    def load(cls, driver: neo4j.Driver, species_id: int) -> "AliasIndex":
+        """
+        Build the index from the `Protein` and `TG` nodes of a species.
+        """
+        stopwatch = Stopwatch()
+        version = release_version()
+
+        # Both tables are independent and fetched concurrently
+        async_driver = database.get_async_driver()
+        protein_names, gene_aliases = database.gather(
+            queries.get_protein_names_async(async_driver, species_id),
+            queries.get_gene_aliases_async(async_driver, species_id),
+        )
+
+        proteins: Dict[str, list[str]] = {}
+        for row in protein_names:
+            for name in {row["id"], row["symbol"], row["ensembl_gene"]}:
+                if name:
+                    proteins.setdefault(name.upper(), []).append(row["id"])
+
+        # Lists are stored as strings, evaluate to lists using JSON.
+        aliases: Dict[str, list[str]] = {}
+        for row in gene_aliases:
+            value = row["aliases"]
+            try:
+                alias_list = json.loads(value)
+            except json.JSONDecodeError:
+                alias_list = json.loads(value.replace("'", '"'))
+            for alias in set(alias_list):
+                aliases.setdefault(alias.upper(), []).append(row["symbol"])
+
+        stopwatch.total("alias_index_load")
+        return cls(species_id, proteins, aliases, version)
+
+    def resolve(self, names: Iterable[str]) -> Tuple[list[str], dict[str, str]]:
+        """
+        Replace aliases by their symbols and look up the proteins of all names.
+
+        :param names: upper case symbols, aliases or Ensembl ids
+        :return: protein ids (without duplicates) and a dictionary of format
+            (Symbol: Alias) of all the symbols found from aliases
+        """
+        genes_set = set(names)
+        symbols_set, aliases_set = set(), set()
+        mapping: dict[str, str] = {}
+        for name in genes_set:
+            for symbol in self.aliases.get(name, []):
+                symbols_set.add(symbol)
+                aliases_set.add(name)
+                # Only add the (symbol: alias) if the symbol isnt there already
+                mapping.setdefault(symbol, name)
+
+        # Aliases are replaced by their symbols, symbols given directly are kept
+        result_names = (genes_set - aliases_set) | (symbols_set - genes_set)
+        protein_ids = dict.fromkeys(
+            protein_id
+            for name in result_names
+            for protein_id in self.proteins.get(name.upper(), [])
+        )
+        return list(protein_ids), mapping
+
+
+def get_alias_index(driver: neo4j.Driver, species_id: int) -> AliasIndex:
+    """
+    :return: the alias index of the species, built on first use or after a new data release
+    """
+    index = _indexes.get(species_id)
+    if index is not None and index.version == release_version():
+        return index
+    with _lock:
+        index = _indexes.get(species_id)
+        if index is None or index.version != release_version():
+            index = AliasIndex.load(driver, species_id)
+            _indexes[species_id] = index
+        return index
+
+
+def refresh(driver: neo4j.Driver, species_id: Optional[int] = None):
+    """
+    Rebuild the index of one species, or of every loaded species if `species_id` is None.
+    """
+    with _lock:
+        species = list(_indexes) if species_id is None else [species_id]
+        for species_id in species:
+            _indexes[species_id] = AliasIndex.load(driver, species_id)
+
+
+def resolve_names(
+    driver: neo4j.Driver, names: list[str], species_id: int
+) -> Tuple[list[str], dict[str, str]]:
+    """
+    Returns: protein_id and a dictionary of format (Symbol: Alias) of all the symbols found from aliases
+    """
+    index = get_alias_index(driver, species_id)
+    return index.resolve(name.upper() for name in names)
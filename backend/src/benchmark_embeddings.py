@@ -0,0 +1,112 @@
+"""
+Benchmark of the compressed embedding stores (summarization/compression.py):
+recall@k of every configuration against exact float32 cosine similarity,
+together with the memory of the codes and the scoring latency.
+
+Queries are embeddings of random abstracts, the abstract itself is excluded
+from its results. The corpus can be limited to a random subset to keep the
+exact search affordable, only this subset is compressed.
+
+Usage (from backend/src): python benchmark_embeddings.py [--corpus 100000] [--queries 200] [--k 10]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from summarization.compression import compress
+from summarization.embedding_store import EmbeddingStore
+from summarization.vector_index import top_k
+
+# (dtype, dimension, projection)
+_CONFIGURATIONS = [
+    ("float16", None, None),
+    ("int8", None, None),
+    ("float16", 1024, "pca"),
+    ("int8", 1024, "pca"),
+    ("int8", 512, "pca"),
+    ("int8", 256, "pca"),
+    ("int8", 1024, "random"),
+    ("int8", 512, "random"),
+]
+
+
+def recall_at_k(store, rows, queries, exact, k):
+    """
+    :return: mean recall@k and median latency of scoring all rows for one query
+    """
+    recalls, timings = [], []
+    for query, query_row, expected in zip(queries, exact["rows"], exact["top"]):
+        start = time.perf_counter()
+        scores = store.scores(query, rows)
+        scores[rows == query_row] = -np.inf
+        found = rows[top_k(scores, k)]
+        timings.append(time.perf_counter() - start)
+        recalls.append(len(np.intersect1d(found, expected)) / k)
+    return float(np.mean(recalls)), float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    full_store = EmbeddingStore.open()
+    if full_store is None:
+        raise SystemExit("Build the embedding store first")
+    rng = np.random.default_rng(args.seed)
+    sample = np.sort(
+        rng.choice(len(full_store), min(args.corpus, len(full_store)), False)
+    )
+    # Only the corpus is compressed for every configuration, not the whole store
+    store = EmbeddingStore(
+        full_store.pmids[sample],
+        full_store.embeddings[sample],
+        full_store.norms[sample],
+    )
+    rows = np.arange(len(store))
+    query_rows = rng.choice(rows, min(args.queries, len(rows)), False)
+    queries = np.asarray(store.embeddings[query_rows], dtype=np.float32)
+
+    exact = {"rows": query_rows, "top": []}
+    for query, query_row in zip(queries, query_rows):
+        scores = store.scores(query, rows)
+        scores[rows == query_row] = -np.inf
+        exact["top"].append(rows[top_k(scores, args.k)])
+    _, float32_latency = recall_at_k(store, rows, queries, exact, args.k)
+    float32_bytes = store.dimension * 4
+
+    print(
+        f"{'dtype':>8} {'dim':>6} {'projection':>10} {'bytes/vec':>10} "
+        f"{'recall@' + str(args.k):>10} {'latency (ms)':>13}"
+    )
+    print(
+        f"{'float32':>8} {store.dimension:>6} {'-':>10} {float32_bytes:>10} "
+        f"{1.0:>10.3f} {float32_latency * 1000:>13.2f}"
+    )
+    for dtype, dimension, projection in _CONFIGURATIONS:
+        if dimension is not None and dimension >= store.dimension:
+            continue
+        with tempfile.TemporaryDirectory() as directory:
+            compressed = compress(
+                store,
+                os.path.join(directory, "compressed"),
+                dtype,
+                dimension,
+                projection or "pca",
+            )
+            recall, latency = recall_at_k(compressed, rows, queries, exact, args.k)
+            print(
+                f"{dtype:>8} {compressed.codes.shape[1]:>6} {projection or '-':>10} "
+                f"{compressed.nbytes // len(compressed):>10} "
+                f"{recall:>10.3f} {latency * 1000:>13.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
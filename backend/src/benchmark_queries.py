@@ -0,0 +1,125 @@
+"""
+Benchmark of the STRING association query: ids interpolated into the query
+text (the form used before queries.py was parameterized) against the
+parameterized form of `queries.get_protein_associations` and the block pair
+queries of `queries.get_induced_edges_sharded_async` run concurrently.
+
+The interpolated query is new text for every id list, so Neo4j plans it on
+every call; the parameterized query is planned once and its plan is reused.
+Every repetition therefore uses a freshly drawn id list, the same lists for
+all forms, and all forms return the same columns (protein ids and score).
+
+Usage (from backend/src): python benchmark_queries.py [--species 10090] [--repeat 5]
+"""
+
+import argparse
+import statistics
+import time
+
+import database
+import queries
+
+_SIZES = [10, 100, 1000, 5000, 10000]
+
+_INTERPOLATED_QUERY = """
+    MATCH (source:Protein:{species})-[association:STRING]->(target:Protein:{species})
+    WHERE source.ENSEMBL_PROTEIN IN {protein_ids}
+        AND target.ENSEMBL_PROTEIN IN {protein_ids}
+        AND association.Score >= {threshold}
+    RETURN source.ENSEMBL_PROTEIN AS source, target.ENSEMBL_PROTEIN AS target,
+        association.Score AS score
+"""
+
+
+def sample_protein_ids(driver, species: str, size: int) -> list[str]:
+    query = f"""
+        MATCH (protein:Protein:{species})
+        WITH protein.ENSEMBL_PROTEIN AS id ORDER BY rand()
+        RETURN collect(id)[..$size] AS ids
+    """
+    with driver.session() as session:
+        return session.run(query, size=size).single(strict=True)["ids"]
+
+
+def run_interpolated(driver, protein_ids, threshold, species):
+    query = _INTERPOLATED_QUERY.format(
+        species=species, protein_ids=protein_ids, threshold=threshold
+    )
+    with driver.session() as session:
+        result = session.run(query)
+        source, _, _ = queries._convert_to_edge_columns(
+            result.values("source", "target", "score")
+        )
+        return len(source)
+
+
+def run_parameterized(driver, protein_ids, threshold, species_id):
+    source, _, _ = queries.get_protein_associations(
+        driver, protein_ids, threshold, species_id
+    )
+    return len(source)
+
+
+def run_sharded(protein_ids, threshold, species_id):
+    source, _, _ = database.run_async(
+        queries.get_induced_edges_sharded_async(
+            database.get_async_driver(), protein_ids, threshold, species_id
+        )
+    )
+    return len(source)
+
+
+def measure(fn, id_lists):
+    """
+    :param id_lists: one id list per call, the first call warms up the connection
+    :return: median number of returned edges, latency of the first call and median
+        latency of the following calls
+    """
+    edges, timings = [], []
+    for protein_ids in id_lists:
+        start = time.perf_counter()
+        edges.append(fn(protein_ids))
+        timings.append(time.perf_counter() - start)
+    return statistics.median(edges), timings[0], statistics.median(timings[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--species", type=int, default=10090)
+    parser.add_argument("--threshold", type=int, default=700)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    driver = database.init_driver()
+    species = queries._species(args.species)
+
+    print(f"{'ids':>6} {'form':>14} {'edges':>8} {'first (s)':>10} {'median (s)':>11}")
+    for size in _SIZES:
+        # A new id list for every call, a repeated text would hit the plan cache
+        id_lists = [
+            sample_protein_ids(driver, species, size) for _ in range(args.repeat + 1)
+        ]
+        for name, fn in [
+            (
+                "interpolated",
+                lambda ids: run_interpolated(driver, ids, args.threshold, species),
+            ),
+            (
+                "parameterized",
+                lambda ids: run_parameterized(
+                    driver, ids, args.threshold, args.species
+                ),
+            ),
+            (
+                "sharded",
+                lambda ids: run_sharded(ids, args.threshold, args.species),
+            ),
+        ]:
+            edges, first, median = measure(fn, id_lists)
+            print(f"{size:>6} {name:>14} {edges:>8.0f} {first:>10.3f} {median:>11.3f}")
+    database.close_async_driver()
+    database.close_driver()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import glob
 import os
 import time
 
+import schema
 from dotenv import load_dotenv
 from neo4j import GraphDatabase
 
@@ -29,13 +30,9 @@ def run_query(query):
         session.run(query)
 
 
-index_query = "CREATE INDEX gene_index FOR (n:TG) ON (n.SYMBOL)"
-run_query(index_query)
-print("index created")
-
-constraint_query = "CREATE CONSTRAINT ON (n:abstract) ASSERT n.PMID IS UNIQUE"
-run_query(constraint_query)
-print("constraint created")
+# Indexes and constraints, among them TG.SYMBOL and the unique abstract.PMID
+schema.create_schema(driver)
+print("indexes and constraints created")
 
 # Loop through each file and execute the abstract node creation query
 for csv_file in csv_files:
@@ -103,4 +100,21 @@ for csv_file in csv_files:
     # Execute the query for the current file
     run_query(cypher_query)
     print(f"Processed citation links of file: {csv_file} in {time.time()-cites_time}")
+
+# Store the number of references and the citation threshold of the top 15% per gene,
+# used by queries.get_abstracts to select abstracts in a single traversal
+rank_time = time.time()
+cypher_query = """
+  CALL apoc.periodic.iterate(
+    "MATCH (g:TG) WHERE (g)-[:REFERENCES]->() RETURN g",
+    "
+    MATCH (g)-[:REFERENCES]->(a:abstract)
+    WITH g, count(a) AS total, percentileCont(a.times_cited, 0.85) AS threshold
+    SET g.reference_count = total, g.citation_threshold = threshold
+    ",
+    {batchSize:1000, parallel:true, retries:10}
+  )
+  """
+run_query(cypher_query)
+print(f"Processed citation ranks in {time.time()-rank_time}")
 driver.close()
@@ -1,28 +1,181 @@
 """
 Connection interface towards the Neo4j databases.
+
+Every server process holds a single driver, and with it a single connection
+pool, that is opened once at startup and closed when the process exits.
+Query helpers must never close it.
+
+Independent queries of one request can run concurrently on the async
+driver: `gather` awaits the `*_async` functions of `queries.py` on an event
+loop that runs in a background thread of the process, so that synchronous
+request handlers wait for the slowest query instead of the sum of all.
 """
 
+import asyncio
+import atexit
 import os
+import threading
+from typing import Any, Awaitable, Optional
 
 import neo4j
 from dotenv import load_dotenv
-from flask import g
 
+_driver: Optional[neo4j.Driver] = None
+# Process that opened the driver, connections must not be shared with forked children
+_driver_pid: Optional[int] = None
+_lock = threading.Lock()
 
-def get_driver() -> neo4j.Driver:
+_async_driver: Optional[neo4j.AsyncDriver] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+# Process that started the event loop, its thread does not survive a fork
+_loop_pid: Optional[int] = None
+_async_lock = threading.Lock()
+
+
+def _config() -> tuple[str, tuple, dict]:
+    """
+    :return: uri, auth and pool configuration of the drivers, see `init_driver`
     """
+    # Load environment variables from .env file
+    load_dotenv()
+
+    # set config
+    NEO4J_HOST = os.getenv("NEO4J_HOST")
+    NEO4J_PORT = os.getenv("NEO4J_PORT")
+    NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
+    NEO4J_USERNAME = os.getenv("NEO4J_USERNAME")
+    uri = f"bolt://{NEO4J_HOST}:{NEO4J_PORT}"
+    pool = {
+        "max_connection_pool_size": int(os.getenv("NEO4J_MAX_POOL_SIZE", "100")),
+        "liveness_check_timeout": float(
+            os.getenv("NEO4J_LIVENESS_CHECK_TIMEOUT", "60")
+        ),
+        "connection_acquisition_timeout": float(
+            os.getenv("NEO4J_ACQUISITION_TIMEOUT", "60")
+        ),
+    }
+    return uri, (NEO4J_USERNAME, NEO4J_PASSWORD), pool
+
+
+def init_driver() -> neo4j.Driver:
+    """
+    Open the driver of this process, configured by the environment:
+    `NEO4J_MAX_POOL_SIZE` (connections, default 100), `NEO4J_LIVENESS_CHECK_TIMEOUT`
+    (idle seconds before a pooled connection is checked, default 60) and
+    `NEO4J_ACQUISITION_TIMEOUT` (seconds to wait for a free connection, default 60).
+
     :return: neo4j-driver object that is needed when calling functions of `queries.py`
     """
-    if "db" not in g:
-        # Load environment variables from .env file
-        load_dotenv()
+    global _driver, _driver_pid
+    with _lock:
+        if _driver is not None and _driver_pid == os.getpid():
+            return _driver
 
-        # set config
-        NEO4J_HOST = os.getenv("NEO4J_HOST")
-        NEO4J_PORT = os.getenv("NEO4J_PORT")
-        NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
-        NEO4J_USERNAME = os.getenv("NEO4J_USERNAME")
+        uri, auth, pool = _config()
         # connect
-        uri = f"bolt://{NEO4J_HOST}:{NEO4J_PORT}"
-        g.db = neo4j.GraphDatabase.driver(uri, auth=(NEO4J_USERNAME, NEO4J_PASSWORD))
-    return g.db
+        _driver = neo4j.GraphDatabase.driver(uri, auth=auth, **pool)
+        _driver_pid = os.getpid()
+        return _driver
+
+
+def get_driver() -> neo4j.Driver:
+    """
+    :return: neo4j-driver object that is needed when calling functions of `queries.py`
+    """
+    if _driver is not None and _driver_pid == os.getpid():
+        return _driver
+    return init_driver()
+
+
+def close_driver():
+    """
+    Close the driver of this process and all of its pooled connections.
+    """
+    global _driver, _driver_pid
+    with _lock:
+        if _driver is not None and _driver_pid == os.getpid():
+            _driver.close()
+        _driver, _driver_pid = None, None
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """
+    :return: the event loop of this process, started on first use
+    """
+    global _loop, _loop_pid, _async_driver
+    with _async_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            # A driver inherited from the parent process belongs to its loop
+            _async_driver = None
+            threading.Thread(
+                target=_loop.run_forever, name="neo4j-async", daemon=True
+            ).start()
+        return _loop
+
+
+def run_async(coroutine: Awaitable) -> Any:
+    """
+    Run a coroutine on the event loop of this process and wait for its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop()).result()
+
+
+async def _gather(*coroutines: Awaitable) -> list:
+    return list(await asyncio.gather(*coroutines))
+
+
+def gather(*coroutines: Awaitable) -> list:
+    """
+    Run independent queries concurrently, e.g.
+    `gather(queries.get_number_of_genes_async(get_async_driver(), 10090), ...)`
+
+    :return: their results in the given order
+    """
+    return run_async(_gather(*coroutines))
+
+
+async def _open_async_driver() -> neo4j.AsyncDriver:
+    uri, auth, pool = _config()
+    return neo4j.AsyncGraphDatabase.driver(uri, auth=auth, **pool)
+
+
+def get_async_driver() -> neo4j.AsyncDriver:
+    """
+    :return: async neo4j-driver object of this process, bound to its event loop
+        (only to be used with `gather` or `run_async`)
+    """
+    global _async_driver
+    loop = _event_loop()
+    driver = _async_driver
+    if driver is None:
+        opened = asyncio.run_coroutine_threadsafe(_open_async_driver(), loop).result()
+        with _async_lock:
+            if _async_driver is None:
+                _async_driver = opened
+            driver = _async_driver
+        # Another thread opened a driver meanwhile
+        if driver is not opened:
+            asyncio.run_coroutine_threadsafe(opened.close(), loop).result()
+    return driver
+
+
+def close_async_driver():
+    """
+    Close the async driver and stop the event loop of this process.
+    """
+    global _async_driver, _loop, _loop_pid
+    with _async_lock:
+        driver, loop, pid = _async_driver, _loop, _loop_pid
+        _async_driver, _loop, _loop_pid = None, None, None
+    # The loop of a parent process does not run in a forked child
+    if loop is None or pid != os.getpid():
+        return
+    if driver is not None:
+        asyncio.run_coroutine_threadsafe(driver.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+atexit.register(close_driver)
+atexit.register(close_async_driver)
@@ -1,68 +1,233 @@
-import csv
-import json
-import multiprocessing
-import sys
-from functools import lru_cache
-from typing import Any
-
-import mpmath
+import os
+from typing import Any, Dict, Optional
+
 import neo4j
+import numpy as np
 import pandas as pd
-import queries
+import scipy.sparse as sp
+import term_store
+import workers
+from dotenv import load_dotenv
+from scipy.stats import hypergeom
+from util.lru_cache import LRUCache
 from util.stopwatch import Stopwatch
 
+# Set cutoff value for p_value and fdr_rate
+_CUTOFF = 1e-318
 
-def calc_genes_pval(
-    curr, alpha, in_gene, bg_genes, num_in_genes, mapping, symbol_alias_mapping
-):
-    # Lists are read as strings, evaluate to lists using JSON.
-    # alternative is using eval() which is slower
-    gene_list = curr.replace("'", '"')
-    gene_list = json.loads(gene_list)
-    # get the protein length of term
-    num_term_prot = len(gene_list)
-
-    # Get intersection of proteins
-    gene_term = list(set(gene_list) & in_gene)
-    gene_term = [
+# Load .env file
+load_dotenv()
+# Results of functional_enrichment, keyed by species, normalized input genes,
+# alias mapping and load generation of the term store
+result_cache = LRUCache(maxsize=int(os.getenv("ENRICHMENT_CACHE_SIZE", "256")))
+# Intersection counts of the last enrichment of every session
+session_states = LRUCache(maxsize=int(os.getenv("ENRICHMENT_SESSIONS", "128")))
+
+
+def hypergeometric_pvalues(intersec, total_genes, term_genes, in_genes) -> np.ndarray:
+    """Vectorized one-sided hypergeometric test for a batch of terms.
+    Args:
+        intersec(array): number of intersections between input and
+            term genes, one entry per term
+        total_genes(int): number of total genes of organism (background)
+        term_genes(array): number of genes of every term
+        in_genes(int): number of input genes given by the user
+    Return:
+        p_values(array): probability of observing at least `intersec`
+            term genes in the input, i.e. the upper tail P(X >= intersec).
+            The tail is evaluated by scipy in log-gamma space, so large
+            backgrounds neither overflow nor lose precision."""
+    intersec = np.asarray(intersec, dtype=np.int64)
+    term_genes = np.asarray(term_genes, dtype=np.int64)
+    return hypergeom.sf(intersec - 1, total_genes, term_genes, in_genes)
+
+
+def benjamini_hochberg(p_values, n_tests: Optional[int] = None) -> np.ndarray:
+    """Vectorized Benjamini-Hochberg FDR correction
+    Args:
+        p_values(array): p-values of the tested terms
+        n_tests(int): total number of tests; defaults to len(p_values). Terms
+            that were not passed in are treated as having a p-value of 1.
+    Return:
+        fdr(array): adjusted p-values in the order of `p_values`"""
+    p_values = np.asarray(p_values, dtype=np.float64)
+    if n_tests is None:
+        n_tests = len(p_values)
+    order = np.argsort(p_values, kind="stable")
+    ranked = p_values[order] * n_tests / np.arange(1, len(p_values) + 1)
+    # Ensure FDR rates are non-decreasing with the p-value
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    fdr = np.empty_like(ranked)
+    fdr[order] = np.minimum(ranked, 1.0)
+    return fdr
+
+
+def _input_genes(in_genes, alias_symbol_mapping: dict) -> tuple[dict, set]:
+    """Normalize the input genes of the user
+    Return:
+        mapping(dict): upper case input name -> input name
+        genes(set): upper case symbols, aliases are replaced by their symbol"""
+    mapping = {i.upper(): i for i in in_genes}
+    genes = {
+        gene if gene not in alias_symbol_mapping else alias_symbol_mapping[gene]
+        for gene in mapping
+    }
+    return mapping, genes
+
+
+def _input_symbols(
+    store: term_store.TermStore,
+    rows: np.ndarray,
+    gene_idx: np.ndarray,
+    mapping: dict,
+    symbol_alias_mapping: dict,
+) -> list[list[str]]:
+    """Input genes of every term in `rows`, mapped back to the names given
+    by the user
+    Args:
+        store(TermStore): term store of the species
+        rows(array): term rows of the store
+        gene_idx(array): gene columns of the store that belong to the input
+        mapping(dict): upper case input name -> input name
+        symbol_alias_mapping(dict): symbol -> alias the user has given
+    Return:
+        symbols(list): one list of input names per row"""
+    names = [
         mapping[i] if i in mapping else mapping[symbol_alias_mapping[i]]
-        for i in gene_term
+        for i in store.genes[gene_idx]
+    ]
+    sub = store.incidence[rows][:, gene_idx]
+    return [
+        [names[j] for j in sub.indices[sub.indptr[i] : sub.indptr[i + 1]]]
+        for i in range(len(rows))
     ]
-    num_inter = len(gene_term)
 
-    if num_inter == 0:
-        # Condition reduces runtime by 60%, needs to be tested carefully!
-        # Check if enriched terms with and without that condition are
-        # more or less the same
-        p_value = alpha
-    else:
-        p_value = hypergeo_testing(num_inter, bg_genes, num_term_prot, num_in_genes)
 
-    return (p_value, gene_term)
+def _score_candidates(
+    shared: dict, gene_idx: np.ndarray, num_genes: int, num_in_gene: int, n_tests: int
+):
+    """Score all terms sharing a gene with the input, runs in the worker pool
+    Args:
+        shared(dict): handles of the term store arrays, see TermStore.shared
+        gene_idx(array): gene columns of the store that belong to the input
+        num_genes(int): background size
+        num_in_gene(int): number of input genes
+        n_tests(int): number of terms of the species
+    Return:
+        candidates(array): term rows
+        p_values(array): p-value of every candidate
+        fdr_rates(array): Benjamini-Hochberg FDR of every candidate"""
+    candidates, num_inter = term_store.gather_terms(
+        workers.attach(shared["indptr"]), workers.attach(shared["indices"]), gene_idx
+    )
+    term_sizes = workers.attach(shared["term_sizes"])[candidates]
+    p_values = hypergeometric_pvalues(num_inter, num_genes, term_sizes, num_in_gene)
+    return candidates, p_values, benjamini_hochberg(p_values, n_tests=n_tests)
+
+
+def _score_session(
+    store: term_store.TermStore, session_id: str, gene_idx: np.ndarray, num_in_gene
+):
+    """Score the input by updating the intersection counts of the previous
+    enrichment of the session with the genes that were added or removed
+    since, instead of counting all intersections again
+    Args:
+        store(TermStore): term store of the species
+        session_id(str): key of the session state
+        gene_idx(array): gene columns of the store that belong to the input
+        num_in_gene(int): number of input genes
+    Return:
+        candidates(array): term rows
+        p_values(array): p-value of every candidate
+        fdr_rates(array): Benjamini-Hochberg FDR of every candidate"""
+    counts = None
+    state = session_states.get(session_id)
+    if state is not None and state["store"] is store:
+        added = np.setdiff1d(gene_idx, state["gene_idx"], assume_unique=True)
+        removed = np.setdiff1d(state["gene_idx"], gene_idx, assume_unique=True)
+        # Updating only pays off while the edit is smaller than the input itself
+        if len(added) + len(removed) < len(gene_idx):
+            counts = state["counts"].copy()
+            terms, num_inter = store.candidate_terms(added)
+            counts[terms] += num_inter
+            terms, num_inter = store.candidate_terms(removed)
+            counts[terms] -= num_inter
+    if counts is None:
+        counts = np.zeros(len(store.terms), dtype=np.int32)
+        terms, num_inter = store.candidate_terms(gene_idx)
+        counts[terms] = num_inter
+    session_states.put(
+        session_id, {"store": store, "gene_idx": gene_idx, "counts": counts}
+    )
+
+    candidates = np.flatnonzero(counts)
+    p_values = hypergeometric_pvalues(
+        counts[candidates], store.num_genes, store.term_sizes[candidates], num_in_gene
+    )
+    return (
+        candidates,
+        p_values,
+        benjamini_hochberg(p_values, n_tests=len(store.terms)),
+    )
 
 
-@lru_cache(maxsize=None)
-def hypergeo_testing(intersec, total_genes, term_genes, in_genes):
-    """Perfoms hypergeometric testing and returns a p_value
+def _score_background(
+    store: term_store.TermStore,
+    gene_idx: np.ndarray,
+    background_idx: np.ndarray,
+    num_background: int,
+    num_in_gene: int,
+):
+    """Score the input against a custom background. Term sizes are restricted
+    to the background with a bitset AND and popcount per term; terms without
+    any background gene cannot be enriched and are not counted as tests
     Args:
-        intersec(int): number of intersections between input and
-            term proteins
-        total_proteins(int): number of total proteins of organism
-        term_proteins(int): number of proteins for a specific term
-        in_proteins(int): number of input proteins given by the user
+        store(TermStore): term store of the species
+        gene_idx(array): gene columns of the input, all within the background
+        background_idx(array): gene columns of the background
+        num_background(int): number of background genes, including genes
+            that are not part of any term
+        num_in_gene(int): number of input genes within the background, counted
+            like `num_background`, i.e. including genes that are not part of any term
     Return:
-        p-value(float): p-value of hypergeometric testing"""
-    # Set the decimal precision
-    mpmath.mp.dps = 64
+        candidates(array): term rows
+        p_values(array): p-value of every candidate
+        fdr_rates(array): Benjamini-Hochberg FDR of every candidate"""
+    background = term_store.pack_bits(
+        np.array([0, len(background_idx)]), background_idx, len(store.genes)
+    )[0]
+    term_sizes = store.background_term_sizes(background)
 
-    # Do the relevant calculations for the hypergeometric testing
-    term_one = mpmath.binomial(term_genes, intersec)
-    term_two = mpmath.binomial(total_genes - term_genes, in_genes - intersec)
-    term_three = mpmath.binomial(total_genes, in_genes)
+    candidates, num_inter = store.candidate_terms(gene_idx)
+    p_values = hypergeometric_pvalues(
+        num_inter, num_background, term_sizes[candidates], num_in_gene
+    )
+    n_tests = int(np.count_nonzero(term_sizes))
+    return candidates, p_values, benjamini_hochberg(p_values, n_tests=n_tests)
 
-    # Calculate final p_value
-    p_value = (term_one * term_two) / term_three
-    return float(p_value)
+
+def _result_table(
+    store: term_store.TermStore,
+    candidates: np.ndarray,
+    p_values: np.ndarray,
+    fdr_rates: np.ndarray,
+    gene_idx: np.ndarray,
+    mapping: dict,
+    symbol_alias_mapping: dict,
+    alpha: float,
+) -> pd.DataFrame:
+    """Build the enrichment table of all candidate terms with FDR < alpha,
+    sorted by p_value (descending)"""
+    significant = fdr_rates < alpha
+    rows = candidates[significant]
+    df_terms = store.terms.iloc[rows].copy()
+    df_terms["symbols"] = _input_symbols(
+        store, rows, gene_idx, mapping, symbol_alias_mapping
+    )
+    df_terms["p_value"] = np.maximum(p_values[significant], _CUTOFF)
+    df_terms["fdr_rate"] = np.maximum(fdr_rates[significant], _CUTOFF)
+    df_terms.sort_values(by="p_value", ascending=False, inplace=True)
+    return df_terms.reset_index(drop=True)
 
 
 def functional_enrichment(
@@ -71,6 +236,8 @@ def functional_enrichment(
     species_id: Any,
     symbol_alias_mapping: dict,
     alias_symbol_mapping: dict,
+    session_id: Optional[str] = None,
+    background: Optional[list[str]] = None,
 ):
     """inhouse functional enrichment - performs gene set enrichment analysis
     for a given set of proteins. Calculates p-value and Benjamini-Hochberg FDR
@@ -78,80 +245,426 @@ def functional_enrichment(
     Args:
         in_proteins(list): list with input proteins
         species_id(int): Right now not used; default organism is mus musculus
+        session_id(str): if given, the intersection counts are kept for the
+            session and the next enrichment of an edited gene list only
+            updates the counts of the added and removed genes
+        background(list): genes measured in the experiment, replaces the whole
+            organism as background; input genes outside of it are ignored
     Return:
         rank_lst_fil(list): A list of dictionaries, where each dictionary the
             properties of a term: external_id, name, category, proteins,
             p-value, fdr-rate
     """
     stopwatch = Stopwatch()
-    mapping = {i.upper(): i for i in in_genes}
-    genes = set(mapping.keys())
-    genes = {
-        gene if gene not in alias_symbol_mapping else alias_symbol_mapping[gene]
-        for gene in genes
-    }
-    # Get number of all proteins in the organism (from Cypher)
-    bg_proteins = queries.get_number_of_genes(driver, species_id)
+    mapping, genes = _input_genes(in_genes, alias_symbol_mapping)
     num_in_gene = len(in_genes)
-    # pandas DataFrames for nodes and edges
-    csv.field_size_limit(sys.maxsize)
+    if background is not None:
+        _, background_genes = _input_genes(background, alias_symbol_mapping)
+        genes &= background_genes
+        num_in_gene = len(genes)
+
+    # Terms, gene sets and background size are resident per species
+    store = term_store.get_term_store(driver, species_id)
 
-    # Read Terms and put into Dataframe
-    df_terms = pd.DataFrame(queries.get_enrichment_terms(driver, species_id))
-    tot_tests = len(df_terms)
+    # Identical requests against the same term store load are answered from the cache
+    cache_key = (
+        species_id,
+        tuple(sorted(mapping.items())),
+        num_in_gene,
+        frozenset(symbol_alias_mapping.items()),
+        store.generation,
+        None if background is None else tuple(sorted(background_genes)),
+    )
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        stopwatch.total("functional_enrichment (cached)")
+        return cached.copy()
+
+    gene_idx = store.gene_indices(genes)
 
     stopwatch.round("setup_enrichment")
 
     # set significance level to 0.05
     alpha = 0.05
 
-    # calculate p_value for all terms
-    new_genes = []
-    new_p = []
-    arguments = [
-        (value, alpha, genes, bg_proteins, num_in_gene, mapping, symbol_alias_mapping)
-        for value in df_terms["symbols"]
-    ]
+    # Only terms sharing a gene with the input are scored, all other terms have
+    # no intersection and therefore p_value 1, they still count as tests for FDR
+    # calculate p_value and Benjamini-Hochberg FDR for all candidates in one pass
+    if background is not None:
+        candidates, p_values, fdr_rates = _score_background(
+            store,
+            gene_idx,
+            store.gene_indices(background_genes),
+            len(background_genes),
+            num_in_gene,
+        )
+    elif session_id is None:
+        with store.shared() as shared:
+            candidates, p_values, fdr_rates = workers.submit(
+                _score_candidates,
+                shared,
+                gene_idx,
+                store.num_genes,
+                num_in_gene,
+                len(store.terms),
+            ).result()
+    else:
+        candidates, p_values, fdr_rates = _score_session(
+            store, session_id, gene_idx, num_in_gene
+        )
+    stopwatch.round("pvalue_enrichment")
 
-    with multiprocessing.Pool() as pool:
-        # Apply the function to each input value in parallel and collect the results
-        for a, b in pool.starmap(calc_genes_pval, arguments):
-            new_p.append(a)
-            new_genes.append(b)
+    # Remove all entries where FDR >= 0.05
+    df_terms = _result_table(
+        store,
+        candidates,
+        p_values,
+        fdr_rates,
+        gene_idx,
+        mapping,
+        symbol_alias_mapping,
+        alpha,
+    )
 
-    # Update Dataframe and sort by p_value (descending)
-    df_terms["symbols"] = new_genes
-    df_terms["p_value"] = new_p
-    df_terms.sort_values(by="p_value", ascending=False, inplace=True)
-    df_terms = df_terms.reset_index(drop=True)
+    result_cache.put(cache_key, df_terms.copy())
+
+    stopwatch.round("fdr_enrichment")
+    stopwatch.total("functional_enrichment")
+    return df_terms
+
+
+def reduce_redundancy(
+    driver: neo4j.Driver,
+    df_terms: pd.DataFrame,
+    species_id: Any,
+    threshold: float = 0.5,
+) -> pd.DataFrame:
+    """Cluster enriched terms by the overlap of their gene sets and keep one
+    representative per cluster. Terms are visited from the lowest p-value on;
+    every term not yet clustered becomes a representative and takes all
+    unclustered terms with a Jaccard similarity >= threshold into its cluster
+    Args:
+        df_terms(DataFrame): result of functional_enrichment
+        species_id(int): species of the terms
+        threshold(float): minimal Jaccard similarity of the gene sets of a
+            representative and the members of its cluster
+    Return:
+        df_terms(DataFrame): the representatives, with the additional columns
+            cluster_members (ids of all terms of the cluster, for drill-down)
+            and cluster_size
+    """
+    stopwatch = Stopwatch()
+    store = term_store.get_term_store(driver, species_id)
+    order = np.argsort(df_terms["p_value"].to_numpy(), kind="stable")
+    rows = np.array([store.term_index[term] for term in df_terms["id"]], dtype=np.int64)
+    similar = store.jaccard(rows[order], threshold)
+
+    clustered = np.zeros(len(order), dtype=bool)
+    representatives = []
+    members = []
+    for i in range(len(order)):
+        if clustered[i]:
+            continue
+        neighbours = similar.indices[similar.indptr[i] : similar.indptr[i + 1]]
+        cluster = np.concatenate(([i], neighbours[~clustered[neighbours]]))
+        clustered[cluster] = True
+        representatives.append(order[i])
+        members.append(df_terms["id"].to_numpy()[order[cluster]].tolist())
+
+    df_reduced = df_terms.iloc[representatives].copy()
+    df_reduced["cluster_members"] = members
+    df_reduced["cluster_size"] = [len(cluster) for cluster in members]
+    # Keep the order of the input table
+    df_reduced = df_reduced.sort_index().reset_index(drop=True)
+
+    stopwatch.total("reduce_redundancy")
+    return df_reduced
+
+
+def functional_enrichment_batch(
+    driver: neo4j.Driver,
+    gene_lists: list[list[str]],
+    species_id: Any,
+    symbol_alias_mapping: dict,
+    alias_symbol_mapping: dict,
+) -> list[pd.DataFrame]:
+    """inhouse functional enrichment for several gene lists at once, e.g. one
+    list per community of a protein graph. All lists share the term store and
+    their intersections with every term are computed in one sparse product
+    Args:
+        gene_lists(list): list of input gene lists
+        species_id(int): species of the genes
+    Return:
+        tables(list): one DataFrame per gene list, same format as the
+            result of functional_enrichment
+    """
+    stopwatch = Stopwatch()
+    inputs = [_input_genes(in_genes, alias_symbol_mapping) for in_genes in gene_lists]
+
+    store = term_store.get_term_store(driver, species_id)
+    gene_idx = [store.gene_indices(genes) for _, genes in inputs]
+
+    stopwatch.round("setup_enrichment")
+
+    # set significance level to 0.05
+    alpha = 0.05
+
+    # Input indicator matrix (lists x genes) times the inverted index gives the
+    # intersection sizes of every list with every term (lists x terms)
+    indptr: np.ndarray = np.concatenate(
+        (
+            np.zeros(1, dtype=np.int64),
+            np.cumsum([len(idx) for idx in gene_idx], dtype=np.int64),
+        )
+    )
+    indicator = sp.csr_matrix(
+        (
+            np.ones(indptr[-1], dtype=np.int32),
+            np.concatenate(gene_idx) if gene_idx else np.empty(0, dtype=np.int64),
+            indptr,
+        ),
+        shape=(len(gene_lists), len(store.genes)),
+    )
+    counts = (indicator @ store.gene_terms).tocsr()
+    counts.sort_indices()
+
+    # calculate p_value of every (list, candidate term) pair in one pass
+    num_in_genes = np.repeat(
+        [len(in_genes) for in_genes in gene_lists], np.diff(counts.indptr)
+    )
+    p_values = hypergeometric_pvalues(
+        counts.data, store.num_genes, store.term_sizes[counts.indices], num_in_genes
+    )
     stopwatch.round("pvalue_enrichment")
 
-    # calculate Benjamini-Hochberg FDR
-    p_vals = []
-    rank_lst = []
-    # Set cutoff value for p_value and fdr_rate
-    cutoff = 1e-318
-    prev = 0
-    # Loop over p_value column in Dataframe
-    for i, val in enumerate(df_terms["p_value"]):
-        rank = tot_tests - i
-        p_adj = val * (tot_tests / rank)
-        # Ensure FDR rates are non-increasing
-        if prev < p_adj and i != 0:
-            p_adj = prev
-        prev = p_adj
-        val, p_adj = (
-            (cutoff, cutoff) if val <= cutoff or p_adj <= cutoff else (val, p_adj)
+    tables = []
+    for i, (mapping, _) in enumerate(inputs):
+        start, end = counts.indptr[i], counts.indptr[i + 1]
+        fdr_rates = benjamini_hochberg(p_values[start:end], n_tests=len(store.terms))
+        tables.append(
+            _result_table(
+                store,
+                counts.indices[start:end],
+                p_values[start:end],
+                fdr_rates,
+                gene_idx[i],
+                mapping,
+                symbol_alias_mapping,
+                alpha,
+            )
         )
-        p_vals += [val]
-        rank_lst += [p_adj]
-    # Update Dataframe
-    df_terms["fdr_rate"] = rank_lst
-    df_terms["p_value"] = p_vals
-    # Remove all entries where FDR >= 0.05
-    df_terms = df_terms[df_terms["fdr_rate"] < alpha]
-    df_terms = df_terms.reset_index(drop=True)
 
     stopwatch.round("fdr_enrichment")
-    stopwatch.total("functional_enrichment")
+    stopwatch.total("functional_enrichment_batch")
+    return tables
+
+
+def running_sum_scores(
+    positions: np.ndarray,
+    weights: np.ndarray,
+    term_ptr: np.ndarray,
+    num_ranked: int,
+    segment: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Vectorized GSEA running-sum enrichment scores of many terms at once.
+    The running sum only changes direction at hits, so its maximum lies
+    right after a hit and its minimum right before one; both are evaluated
+    for all hits of all terms with array operations.
+    Args:
+        positions(array): ranks of the term genes in the ranked list, sorted
+            within each term and concatenated for all terms
+        weights(array): |score|^p of the gene at each position
+        term_ptr(array): CSR-style pointers, term `t` owns
+            positions[term_ptr[t]:term_ptr[t + 1]], every term owns >= 1
+        num_ranked(int): length of the ranked list
+        segment(array): term of every position, derived from term_ptr if None
+    Return:
+        es(array): enrichment score of every term"""
+    starts = term_ptr[:-1]
+    sizes = np.diff(term_ptr)
+    if segment is None:
+        segment = np.repeat(np.arange(len(sizes)), sizes)
+
+    # running sum of the hit weights within every term
+    cum_weights = np.cumsum(weights)
+    cum_weights -= (cum_weights[starts] - weights[starts])[segment]
+    total_weights = cum_weights[term_ptr[1:] - 1]
+    total_weights[total_weights == 0] = 1.0
+
+    # misses before each hit (position minus earlier hits), each costs 1 / (N - k)
+    hit_number = np.arange(len(positions)) - starts[segment]
+    miss_cost = 1.0 / np.maximum(num_ranked - sizes, 1)
+    miss_penalty = (positions - hit_number) * miss_cost[segment]
+    after_hit = cum_weights / total_weights[segment] - miss_penalty
+    before_hit = after_hit - weights / total_weights[segment]
+
+    es_max = np.maximum(np.maximum.reduceat(after_hit, starts), 0.0)
+    es_min = np.minimum(np.minimum.reduceat(before_hit, starts), 0.0)
+    return np.where(es_max >= -es_min, es_max, es_min)
+
+
+def _permutation_scores(
+    positions: np.ndarray,
+    term_ptr: np.ndarray,
+    ranked_weights: np.ndarray,
+    num_permutations: int,
+    seed: int,
+) -> np.ndarray:
+    """Null enrichment scores of gene set permutations, runs in the worker pool
+    Args:
+        positions(array): term positions as for running_sum_scores
+        term_ptr(array): term pointers as for running_sum_scores
+        ranked_weights(array): weight of every position of the ranked list
+        num_permutations(int): number of permutations to draw
+        seed(int): seed of this block of permutations
+    Return:
+        null(array): (num_permutations x terms) enrichment scores"""
+    rng = np.random.default_rng(seed)
+    num_ranked = len(ranked_weights)
+    segment = np.repeat(np.arange(len(term_ptr) - 1), np.diff(term_ptr))
+    # Sorting (term, position) keys sorts the positions within every term
+    offsets = segment * num_ranked
+    null = np.empty((num_permutations, len(term_ptr) - 1))
+    for i in range(num_permutations):
+        # Every term gets random genes of the ranked list, keeping its size
+        shuffled = np.sort(offsets + rng.permutation(num_ranked)[positions])
+        shuffled -= offsets
+        null[i] = running_sum_scores(
+            shuffled, ranked_weights[shuffled], term_ptr, num_ranked, segment
+        )
+    return null
+
+
+def preranked_enrichment(
+    driver: neo4j.Driver,
+    in_genes: list[str],
+    scores: list[float],
+    species_id: Any,
+    symbol_alias_mapping: dict,
+    alias_symbol_mapping: dict,
+    num_permutations: int = 1000,
+    min_size: int = 5,
+    max_size: int = 500,
+    weight: float = 1.0,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """inhouse preranked (GSEA-style) enrichment - tests whether the genes of
+    a term accumulate at the top or bottom of the input ranked by score.
+    Significance comes from gene set permutations, which are spread over the
+    worker pool
+    Args:
+        in_genes(list): input genes
+        scores(list): score of every input gene, e.g. a D-value column
+        species_id(int): species of the genes
+        num_permutations(int): number of permutations of the null distribution
+        min_size(int), max_size(int): only terms with this many input genes
+            are tested
+        weight(float): exponent of the score weights, 0 is the classic
+            Kolmogorov-Smirnov statistic
+        seed(int): seed of the permutations
+    Return:
+        df_terms(DataFrame): terms with FDR < 0.05 with the columns of
+            functional_enrichment plus es and nes (normalized es)
+    Raises:
+        ValueError: if there are no permutations or not one score per gene
+    """
+    if num_permutations < 1:
+        raise ValueError(f"At least one permutation is needed, got {num_permutations}")
+    if len(scores) != len(in_genes):
+        raise ValueError(f"{len(in_genes)} genes but {len(scores)} scores")
+    stopwatch = Stopwatch()
+    mapping, _ = _input_genes(in_genes, alias_symbol_mapping)
+    store = term_store.get_term_store(driver, species_id)
+
+    # Ranked list, highest score first, every input gene is ranked once
+    ranked: Dict[str, float] = {}
+    for gene, score in zip(in_genes, scores):
+        gene = gene.upper()
+        ranked.setdefault(alias_symbol_mapping.get(gene, gene), float(score))
+    ranked_genes = sorted(ranked, key=lambda g: ranked[g], reverse=True)
+    ranked_weights = np.abs(np.array([ranked[g] for g in ranked_genes])) ** weight
+    num_ranked = len(ranked_genes)
+
+    # Positions of the ranked genes in the columns of the term store
+    in_store = [
+        (pos, store.gene_index[gene])
+        for pos, gene in enumerate(ranked_genes)
+        if gene in store.gene_index
+    ]
+    ranked_pos = np.array([pos for pos, _ in in_store], dtype=np.int64)
+    gene_idx = np.array([idx for _, idx in in_store], dtype=np.int64)
+
+    # (terms x ranked genes) hits of all terms with an admissible size
+    hits = store.incidence[:, gene_idx].tocsr()
+    sizes = np.diff(hits.indptr)
+    rows = np.flatnonzero((sizes >= min_size) & (sizes <= max_size))
+    hits = hits[rows]
+    hits.sort_indices()
+    term_ptr = hits.indptr.astype(np.int64)
+    # Columns are in rank order, so the positions are sorted within each term
+    positions = ranked_pos[hits.indices]
+
+    stopwatch.round("setup_preranked")
+
+    es = running_sum_scores(positions, ranked_weights[positions], term_ptr, num_ranked)
+
+    # Permutation nulls, one block of permutations per worker
+    blocks = np.array_split(np.arange(num_permutations), workers.size())
+    futures = [
+        workers.submit(
+            _permutation_scores,
+            positions,
+            term_ptr,
+            ranked_weights,
+            len(block),
+            seed + i,
+        )
+        for i, block in enumerate(blocks)
+        if len(block) > 0
+    ]
+    null = np.vstack([future.result() for future in futures])
+    stopwatch.round("permutations_preranked")
+
+    # Normalize scores and nulls by the mean null score of the same sign of the term
+    positive_null = null >= 0
+    positive_mean = np.where(positive_null, null, 0.0).sum(axis=0) / np.maximum(
+        positive_null.sum(axis=0), 1
+    )
+    negative_mean = -np.where(positive_null, 0.0, null).sum(axis=0) / np.maximum(
+        (~positive_null).sum(axis=0), 1
+    )
+    positive_mean[positive_mean == 0] = 1.0
+    negative_mean[negative_mean == 0] = 1.0
+    nes = np.where(es >= 0, es / positive_mean, es / negative_mean)
+    null = np.where(positive_null, null / positive_mean, null / negative_mean)
+
+    # p-value: fraction of the null scores of all terms with the same sign that
+    # are at least as extreme, pooling gives a resolution beyond 1 / permutations
+    positive_pool = np.sort(null[positive_null])
+    negative_pool = np.sort(-null[~positive_null])
+    p_values = np.where(
+        nes >= 0,
+        (len(positive_pool) - np.searchsorted(positive_pool, nes) + 1)
+        / (len(positive_pool) + 1),
+        (len(negative_pool) - np.searchsorted(negative_pool, -nes) + 1)
+        / (len(negative_pool) + 1),
+    )
+    fdr_rates = benjamini_hochberg(p_values)
+
+    # set significance level to 0.05
+    alpha = 0.05
+    significant = fdr_rates < alpha
+    df_terms = store.terms.iloc[rows[significant]].copy()
+    df_terms["symbols"] = _input_symbols(
+        store, rows[significant], np.sort(gene_idx), mapping, symbol_alias_mapping
+    )
+    df_terms["es"] = es[significant]
+    df_terms["nes"] = nes[significant]
+    df_terms["p_value"] = p_values[significant]
+    df_terms["fdr_rate"] = fdr_rates[significant]
+    df_terms.sort_values(by="p_value", ascending=False, inplace=True)
+    df_terms = df_terms.reset_index(drop=True)
+
+    stopwatch.round("fdr_preranked")
+    stopwatch.total("preranked_enrichment")
     return df_terms
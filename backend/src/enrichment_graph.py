@@ -6,7 +6,7 @@ import database
 import graph
 import jar
 import pandas as pd
-import queries
+import term_store
 from dotenv import load_dotenv
 from util.stopwatch import Stopwatch
 
@@ -26,10 +26,11 @@ def get_functional_graph(list_enrichment, species_id):
 
     driver = database.get_driver()
 
-    # Execute the query and retrieve the CSV data
-    edges = pd.DataFrame(queries.connected_terms(driver, list_term, species_id))
+    # Terms are connected by the gene overlap held in the resident term store
+    store = term_store.get_term_store(driver, species_id)
+    edges = store.overlap_graph(list_term)
 
-    stopwatch.round("Neo4j")
+    stopwatch.round("Overlap")
 
     if len(edges) == 0:
         return
@@ -41,9 +42,10 @@ def get_functional_graph(list_enrichment, species_id):
     )
     # Create nk_graph and needed stats
     nk_graph, node_mapping = graph.nk_graph(nodes, edges)
-    pagerank = graph.pagerank(nk_graph)
-    betweenness = graph.betweenness(nk_graph)
-    ec = graph.eigenvector_centrality(nk_graph)
+    # Centralities are computed in the worker pool while Gephi runs the layout
+    centralities = graph.submit_centrality_scores(
+        nk_graph, ["pagerank", "betweenness", "eigenvector_centrality"]
+    )
 
     # ____________________________________________________________
 
@@ -77,6 +79,10 @@ def get_functional_graph(list_enrichment, species_id):
 
     stopwatch.round("Gephi")
 
+    scores = centralities.result()
+    pagerank, betweenness = scores["pagerank"], scores["betweenness"]
+    ec = scores["eigenvector_centrality"]
+
     # Create a dictionary mapping ENSEMBL IDs to rows in `nodes`
     ensembl_to_node = dict(zip(nodes["external_id"], nodes.itertuples(index=False)))
 
@@ -1,5 +1,6 @@
 import networkit as nk
 import pandas as pd
+import workers
 
 
 def nk_graph(nodes, edges):
@@ -81,3 +82,41 @@ def eigenvector_centrality(graph):
 
     scores = nk.centrality.EigenvectorCentrality(graph).run().scores()
     return scores
+
+
+def centrality_scores(num_nodes, edges, measures):
+    """
+    Return a dictionary of (measure: list of scores) for a graph given by its
+    edge list. Runs in the worker pool, since networkit graphs cannot be
+    passed between processes the graph is rebuilt there.
+
+    Arguments:
+    num_nodes: number of nodes of the graph
+    edges: list of (source, target) integer node ids
+    measures: names of centrality functions of this module, e.g. "pagerank"
+    """
+
+    graph = nk.Graph(num_nodes)
+    for source, target in edges:
+        graph.addEdge(source, target)
+    functions = {
+        "betweenness": betweenness,
+        "pagerank": pagerank,
+        "eigenvector_centrality": eigenvector_centrality,
+    }
+    return {measure: functions[measure](graph) for measure in measures}
+
+
+def submit_centrality_scores(graph, measures):
+    """
+    Return a future of `centrality_scores` computed in the worker pool, so the
+    caller can continue (e.g. with the Gephi layout) in the meantime.
+
+    Arguments:
+    graph: a networkit graph
+    measures: names of centrality functions of this module, e.g. "pagerank"
+    """
+
+    return workers.submit(
+        centrality_scores, graph.numberOfNodes(), list(graph.iterEdges()), measures
+    )
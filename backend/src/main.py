@@ -1,4 +1,5 @@
 import ast
+import hmac
 import io
 import json
 import os
@@ -7,17 +8,24 @@ import signal
 import sys
 from multiprocessing import Process
 
+import alias_index
 import citation_graph
 import database
 import enrichment
 import enrichment_graph
 import graph
 import jar
+import numpy as np
 import pandas as pd
 import queries
+import schema
+import string_graph
+import term_store
+import workers
 from dotenv import load_dotenv
 from flask import Flask, Response, request, send_from_directory
 from summarization import article_graph as summarization
+from summarization import vector_index
 from summarization.chat_bot import chat, make_prompt, populate
 from summarization.model import overall_summary
 from util.stopwatch import Stopwatch
@@ -60,12 +68,34 @@ def proteins_enrichment():
     symbol_alias_mapping = json.loads(request.form.get("mapping"))
     alias_symbol_mapping = {value: key for key, value in symbol_alias_mapping.items()}
     species_id = int(request.form.get("species_id"))
+    # Optional measured background, e.g. all proteins quantified in the experiment
+    background = (
+        request.form.get("background").split(",")
+        if request.form.get("background")
+        else None
+    )
+
+    # Sessions keep intersection counts, so edited gene lists are updated incrementally,
+    # only for clients that send their own session id
+    session_id = request.form.get("session_id") or None
 
     # in-house functional enrichment
     list_enrichment = enrichment.functional_enrichment(
-        driver, genes, species_id, symbol_alias_mapping, alias_symbol_mapping
+        driver,
+        genes,
+        species_id,
+        symbol_alias_mapping,
+        alias_symbol_mapping,
+        session_id=session_id,
+        background=background,
     )
 
+    # Optionally keep one representative of every cluster of redundant terms
+    if request.form.get("reduce") == "true":
+        list_enrichment = enrichment.reduce_redundancy(
+            driver, list_enrichment, species_id
+        )
+
     # STRING API functional enrichment
     """df_enrichment = stringdb.functional_enrichment(proteins, species_id)
 
@@ -86,6 +116,58 @@ def proteins_enrichment():
     return Response(json_str, mimetype="application/json")
 
 
+# Enrichment of several gene lists at once (e.g. one per community)
+@app.route("/api/subgraph/enrichment/batch", methods=["POST"])
+def proteins_enrichment_batch():
+    driver = database.get_driver()
+    gene_lists = json.loads(request.form.get("gene_lists"))
+    symbol_alias_mapping = json.loads(request.form.get("mapping"))
+    alias_symbol_mapping = {value: key for key, value in symbol_alias_mapping.items()}
+    species_id = int(request.form.get("species_id"))
+
+    list_enrichment = enrichment.functional_enrichment_batch(
+        driver, gene_lists, species_id, symbol_alias_mapping, alias_symbol_mapping
+    )
+
+    json_str = json.dumps(
+        [df_terms.to_dict("records") for df_terms in list_enrichment],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return Response(json_str, mimetype="application/json")
+
+
+# Preranked (GSEA-style) enrichment of genes ranked by a score, e.g. a D-value column
+@app.route("/api/subgraph/enrichment/preranked", methods=["POST"])
+def proteins_enrichment_preranked():
+    driver = database.get_driver()
+    genes = request.form.get("genes").split(",")
+    scores = [float(score) for score in request.form.get("scores").split(",")]
+    if len(scores) != len(genes):
+        return Response("Every gene needs exactly one score", status=400)
+    symbol_alias_mapping = json.loads(request.form.get("mapping"))
+    alias_symbol_mapping = {value: key for key, value in symbol_alias_mapping.items()}
+    species_id = int(request.form.get("species_id"))
+    num_permutations = int(request.form.get("permutations", "1000"))
+    if num_permutations < 1:
+        return Response("permutations has to be at least 1", status=400)
+
+    list_enrichment = enrichment.preranked_enrichment(
+        driver,
+        genes,
+        scores,
+        species_id,
+        symbol_alias_mapping,
+        alias_symbol_mapping,
+        num_permutations=num_permutations,
+    )
+
+    json_str = json.dumps(
+        list_enrichment.to_dict("records"), ensure_ascii=False, separators=(",", ":")
+    )
+    return Response(json_str, mimetype="application/json")
+
+
 # ====================== Meillisearch ======================
 # TODO Refactor this
 # Request comes from ContextSection.vue
@@ -158,12 +240,19 @@ def chatbot_response():
     pmids, pmid_abstract, protein_list, funct_terms_list = populate(data)
     # If abstracts are selected, use vector search to filter for most relevant ones
     if len(pmids) > 0:
-        pmids_embeddings = queries.fetch_vector_embeddings(driver=driver, pmids=pmids)
+        index = vector_index.get_vector_index()
+        # Without a local vector index the embeddings come from the database
+        pmids_embeddings = (
+            queries.fetch_vector_embeddings(driver=driver, pmids=pmids)
+            if index is None
+            else None
+        )
         abstracts, pmids = summarization.get_most_relevant_abstracts(
             message=message,
             pmids_embeddings=pmids_embeddings,
             pmid_abstract=pmid_abstract,
             protein_list=protein_list,
+            index=index,
         )
     message = make_prompt(
         message=message,
@@ -179,6 +268,71 @@ def chatbot_response():
     return Response(response, mimetype="application/json")
 
 
+@app.route("/api/subgraph/semantic_search", methods=["POST"])
+def semantic_search():
+    """
+    Search the abstracts of the whole corpus that are most similar to a text.
+    Recieves from frontend:
+        query: search text (string, required)
+        limit: number of returned abstracts (default 20, at least 1)
+    Sends:
+        response: list of format {"PMID": <pmid>, "score": <cosine similarity>}, best first
+    """
+    index = vector_index.get_vector_index()
+    if index is None:
+        return Response("Vector index has not been built", status=503)
+    query = request.form.get("query")
+    if not query:
+        return Response("query is missing", status=400)
+    limit = int(request.form.get("limit", 20))
+    if limit < 1:
+        return Response("limit has to be at least 1", status=400)
+    stopwatch = Stopwatch()
+    embedded_query = summarization.generate_embedding(query)
+    stopwatch.round("Embedding query")
+    pmids, scores = index.search(embedded_query, limit)
+    stopwatch.round("Vector search")
+    response = [
+        {"PMID": pmid, "score": float(score)} for pmid, score in zip(pmids, scores)
+    ]
+    return Response(json.dumps(response), mimetype="application/json")
+
+
+@app.route("/api/cache/stats", methods=["GET"])
+def cache_stats():
+    """
+    Sends: hits, misses, hit rate and size of the in-process caches
+    """
+    response = {
+        "enrichment": enrichment.result_cache.stats(),
+        "query_embeddings": summarization.query_embeddings.stats(),
+        "embedding_batches": summarization.embedding_batch_stats(),
+    }
+    return Response(json.dumps(response), mimetype="application/json")
+
+
+@app.route("/api/admin/refresh", methods=["POST"])
+def refresh_stores():
+    """
+    Reload the in-memory stores after the Neo4j data changed, only allowed with the
+    `X-Refresh-Token` header matching the env `REFRESH_TOKEN`
+    Receives: optional species_id, else every loaded species is reloaded
+    """
+    token = os.getenv("REFRESH_TOKEN")
+    if not token or not hmac.compare_digest(
+        request.headers.get("X-Refresh-Token", ""), token
+    ):
+        return Response("Forbidden", status=403)
+    driver = database.get_driver()
+    species_id = (
+        int(request.form.get("species_id")) if request.form.get("species_id") else None
+    )
+    term_store.refresh(driver, species_id)
+    alias_index.refresh(driver, species_id)
+    string_graph.refresh(species_id)
+    return Response(status=204)
+
+
 # ====================== AI enrich text ======================
 # TODO Refactor this
 # Request comes from ContextSection.vue
@@ -216,7 +370,7 @@ def proteins_subgraph_api():
     )
     threshold = int(float(request.form.get("threshold")) * 1000)
 
-    proteins, protein_ids, symbol_alias_mapping = queries.get_protein_ids_for_names(
+    protein_ids, symbol_alias_mapping = alias_index.resolve_names(
         driver, protein_names, species_id
     )
 
@@ -228,24 +382,28 @@ def proteins_subgraph_api():
 
     if not request.files.get("edge-file"):
 
-        if len(protein_ids) > 1:
-            proteins, source, target, score = queries.get_protein_associations(
-                driver, protein_ids, threshold, species_id
-            )
-        else:
-            proteins, source, target, score = queries.get_protein_neighbours(
-                driver, protein_ids, threshold, species_id
-            )
-
-        nodes = (
-            pd.DataFrame(proteins)
-            .rename(columns={"ENSEMBL_PROTEIN": "external_id"})
-            .drop_duplicates(subset="external_id")
+        fetch_edges = (
+            string_graph.get_protein_associations_async
+            if len(protein_ids) > 1
+            else string_graph.get_protein_neighbours_async
         )
+        # Node attributes and edges are independent, both queries run concurrently
+        async_driver = database.get_async_driver()
+        (proteins, _), (source, target, score) = database.gather(
+            queries.get_proteins_for_ids_async(async_driver, protein_ids, species_id),
+            fetch_edges(async_driver, protein_ids, threshold, species_id),
+        )
+        nodes = pd.DataFrame(proteins).rename(
+            columns={"ENSEMBL_PROTEIN": "external_id"}
+        )
+        # Only proteins with at least one edge are part of the graph
+        if not nodes.empty:
+            nodes = nodes[nodes["external_id"].isin(np.concatenate((source, target)))]
 
         edges = pd.DataFrame({"source": source, "target": target, "score": score})
     else:
 
+        proteins, _ = queries.get_proteins_for_ids(driver, protein_ids, species_id)
         nodes = (
             pd.DataFrame(proteins)
             .rename(columns={"ENSEMBL_PROTEIN": "external_id"})
@@ -268,7 +426,6 @@ def proteins_subgraph_api():
         # Combine both sets to get all unique values
         all_unique_values = unique_sources.union(unique_targets)
         nodes = nodes[(nodes["external_id"].isin(all_unique_values))]
-    driver.close()
     edges = edges.drop_duplicates(subset=["source", "target"])
 
     stopwatch.round("Neo4j")
@@ -279,8 +436,8 @@ def proteins_subgraph_api():
 
     # Networkit related (graph and parameters)
     nk_graph, node_mapping = graph.nk_graph(nodes, edges)
-    betweenness = graph.betweenness(nk_graph)
-    pagerank = graph.pagerank(nk_graph)
+    # Centralities are computed in the worker pool while Gephi runs the layout
+    centralities = graph.submit_centrality_scores(nk_graph, ["betweenness", "pagerank"])
 
     stopwatch.round("Parsing")
 
@@ -316,6 +473,11 @@ def proteins_subgraph_api():
 
     stopwatch.round("Gephi")
 
+    scores = centralities.result()
+    betweenness, pagerank = scores["betweenness"], scores["pagerank"]
+
+    stopwatch.round("Centrality")
+
     # Create a dictionary mapping ENSEMBL IDs to rows in `nodes`
     ensembl_to_node = dict(zip(nodes["external_id"], nodes.itertuples(index=False)))
 
@@ -440,14 +602,28 @@ def run_flask():
 
     app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
+    # Fork the CPU worker pool before any request thread exists
+    workers.start()
+    # One pooled Neo4j driver for the whole server process
+    driver = database.init_driver()
+    # Fail at startup, not per request, if the queries would scan whole labels
+    if os.getenv("NEO4J_SCHEMA_CHECK", "true").lower() == "true":
+        schema.create_schema(driver)
+        schema.verify_query_plans(driver)
+
     # Get host and port from environment variables, with default values
     host = os.getenv("FLASK_RUN_HOST", "127.0.0.1")
     port = int(os.getenv("FLASK_RUN_PORT", "5000"))
 
-    if "--server" in sys.argv:
-        app.run(host=host, port=port)
-    else:
-        app.run()
+    try:
+        if "--server" in sys.argv:
+            app.run(host=host, port=port)
+        else:
+            app.run()
+    finally:
+        database.close_async_driver()
+        database.close_driver()
+        workers.shutdown()
 
 
 if __name__ == "__main__":
@@ -3,181 +3,189 @@ Collection of Cypher queries for writing and reading the resulting
 Neo4j graph database.
 """
 
-from typing import Any, Dict, List, Set, Tuple, Union
+import asyncio
+from typing import Any, Iterator, List, Tuple, Union
 
 import neo4j
+import numpy as np
 from util.stopwatch import Stopwatch
 
+# Labels cannot be query parameters, only these are ever formatted into a query
+_SPECIES = {10090: "Mus_Musculus", 9606: "Homo_Sapiens"}
+
+# Queries that read every node of a label on purpose (in-memory stores and
+# offline builds), exempt from the label scan check of `schema.verify_query_plans`
+FULL_SCAN_QUERIES = {
+    "_GENE_ALIASES_QUERY",
+    "_PROTEIN_NAMES_QUERY",
+    "_STRING_NETWORK_QUERY",
+    "_ENRICHMENT_TERMS_QUERY",
+    "_NUMBER_OF_GENES_QUERY",
+    "_ALL_VECTOR_EMBEDDINGS_QUERY",
+    "_NUMBER_OF_VECTOR_EMBEDDINGS_QUERY",
+}
+
+_GENE_ALIASES_QUERY = """
+    MATCH (n:TG:{species}) WHERE n.ALIAS IS NOT NULL
+    RETURN n.SYMBOL AS symbol, n.ALIAS AS aliases
+"""
 
-def connected_terms(driver: neo4j.Driver, term_ids: list[str], species_id: int):
-    """improved version of get_terms_connected_by_overlap
-    returns: terms, source, target, score"""
-    if species_id == 10090:
-        species = "Mus_Musculus"
-    elif species_id == 9606:
-        species = "Homo_Sapiens"
-
-    query = f"""
-        MATCH (source:FT:{species})-[association:OVERLAP]->(target:FT:{species})
-        WHERE source.Term IN {term_ids}
-            AND target.Term IN {term_ids}
-        RETURN source.Term AS source, target.Term AS target, toInteger(round(association.Score,2)*100) AS score;
-        """
-    with driver.session() as session:
-        result = session.run(query).data()
-        driver.close()
-        return result
+_PROTEIN_NAMES_QUERY = """
+    MATCH (protein:Protein:{species})
+    RETURN protein.ENSEMBL_PROTEIN AS id, protein.SYMBOL AS symbol, protein.ENSEMBL_GENE AS ensembl_gene
+"""
 
+_PROTEINS_FOR_IDS_QUERY = """
+    UNWIND $protein_ids AS protein_id
+    MATCH (protein:Protein:{species} {{ENSEMBL_PROTEIN: protein_id}})
+    RETURN protein, protein.ENSEMBL_PROTEIN AS id, protein.SYMBOL as symbol
+"""
 
-def get_terms_connected_by_overlap(
-    driver: neo4j.Driver, term_ids: list[str], species_id: int
-):
-    """:returns: terms, source, target, score"""
-    if species_id == 10090:
-        species = "Mus_Musculus"
-    elif species_id == 9606:
-        species = "Homo_Sapiens"
-
-    query = f"""
-        MATCH (source:FT:{species})-[association:OVERLAP]->(target:FT:{species})
-        WHERE source.Term IN {term_ids}
-            AND target.Term IN {term_ids}
-        RETURN source, target, association.Score AS score;
-        """
-    with driver.session() as session:
-        result = session.run(query)
-        # custom conversion is needed because otherwise it takes 10s with neo4j (for unknown reasons)
-        return _convert_to_connection_info_score(
-            result=result, _int=False, protein=False
-        )
+_PROTEIN_NEIGHBOURS_QUERY = """
+    UNWIND $protein_ids AS protein_id
+    MATCH (source:Protein:{species} {{ENSEMBL_PROTEIN: protein_id}})-[association:STRING]->(target:Protein:{species})
+    WHERE target.ENSEMBL_PROTEIN IN $protein_ids
+        AND association.combined >= $threshold
+    RETURN source.ENSEMBL_PROTEIN AS source, target.ENSEMBL_PROTEIN AS target, association.combined AS score
+"""
 
+_PROTEIN_ASSOCIATIONS_QUERY = """
+    UNWIND $protein_ids AS protein_id
+    MATCH (source:Protein:{species} {{ENSEMBL_PROTEIN: protein_id}})-[association:STRING]->(target:Protein:{species})
+    WHERE target.ENSEMBL_PROTEIN IN $protein_ids
+        AND association.Score >= $threshold
+    RETURN source.ENSEMBL_PROTEIN AS source, target.ENSEMBL_PROTEIN AS target, association.Score AS score
+"""
 
-def get_protein_ids_for_names(
-    driver: neo4j.Driver, names: list[str], species_id: int
-) -> Tuple[list, list[str], dict[str, str]]:
-    """
-    Returns: protein, protein_id and a dictionary of format (Symbol: Alias) of all the symbols found from aliases
-    """
-    # unsafe parameters because otherwise this query takes 10s with neo4j for unknown reasons
-    if species_id == 10090:
-        species = "Mus_Musculus"
-    elif species_id == 9606:
-        species = "Homo_Sapiens"
-    names = [i.upper() for i in names]
-    query = f"""
-        MATCH (n:TG:Mus_Musculus) WHERE n.ALIAS IS NOT NULL
-        WITH n, apoc.convert.fromJsonList(n.ALIAS) AS alias_list
-        WITH n, [x IN alias_list WHERE x IN {names}] AS matches
-        UNWIND matches AS match
-        RETURN n.SYMBOL AS symbol, match AS found_alias
+# Edges from one block of the ids to another, see `get_induced_edges_sharded_async`
+_PROTEIN_NEIGHBOURS_BLOCK_QUERY = """
+    UNWIND $source_ids AS protein_id
+    MATCH (source:Protein:{species} {{ENSEMBL_PROTEIN: protein_id}})-[association:STRING]->(target:Protein:{species})
+    WHERE target.ENSEMBL_PROTEIN IN $target_ids
+        AND association.combined >= $threshold
+    RETURN source.ENSEMBL_PROTEIN AS source, target.ENSEMBL_PROTEIN AS target, association.combined AS score
+"""
+
+_PROTEIN_ASSOCIATIONS_BLOCK_QUERY = """
+    UNWIND $source_ids AS protein_id
+    MATCH (source:Protein:{species} {{ENSEMBL_PROTEIN: protein_id}})-[association:STRING]->(target:Protein:{species})
+    WHERE target.ENSEMBL_PROTEIN IN $target_ids
+        AND association.Score >= $threshold
+    RETURN source.ENSEMBL_PROTEIN AS source, target.ENSEMBL_PROTEIN AS target, association.Score AS score
+"""
+
+_STRING_NETWORK_QUERY = """
+    MATCH (source:Protein:{species})-[association:STRING]->(target:Protein:{species})
+    RETURN source.ENSEMBL_PROTEIN AS source, target.ENSEMBL_PROTEIN AS target,
+        coalesce(association.Score, -1) AS score, coalesce(association.combined, -1) AS combined
+"""
+
+_ENRICHMENT_TERMS_QUERY = """
+    MATCH (term:FT:{species})
+    RETURN term.Term AS id, split(term.Term, "~")[0] as clean, term.Name AS name, term.Category AS category, term.Symbols AS symbols
+"""
+
+_NUMBER_OF_GENES_QUERY = """
+    MATCH (n:TG:{species})
+    RETURN count(n) AS num_genes
+"""
+
+# Uses the per-gene reference_count and citation_threshold (85th percentile of
+# times_cited) written by build_abstract_database.py. With 2000 or more references
+# in total only the top 15% of every gene are kept, limited to the 2000 most cited.
+_ABSTRACTS_QUERY = """
+    UNWIND $query AS symbol
+    MATCH (n:TG:{species} {{SYMBOL: symbol}})
+    WITH collect(n) AS genes, sum(n.reference_count) AS total_abstracts
+    UNWIND genes AS n
+    MATCH (n)-[:REFERENCES]->(a:abstract)
+    WHERE total_abstracts < 2000 OR a.times_cited >= coalesce(n.citation_threshold, 0)
+    WITH DISTINCT a
+    RETURN a.PMID AS PMID,
+    a.abstract AS abstract,
+    a.title AS title,
+    a.times_cited AS times_cited,
+    a.published AS published,
+    a.cited_by AS citations
+    ORDER BY a.times_cited DESC LIMIT 2000
+"""
+
+_VECTOR_EMBEDDINGS_QUERY = """
+    UNWIND $pmids AS pmid
+    MATCH (a:abstract {PMID: pmid})
+    RETURN DISTINCT a.PMID as PMID, a.abstractEmbedding as abstractEmbedding
+"""
+
+_ALL_VECTOR_EMBEDDINGS_QUERY = """
+    MATCH (a:abstract) WHERE a.abstractEmbedding IS NOT NULL
+    RETURN a.PMID as PMID, a.abstractEmbedding as abstractEmbedding
+"""
+
+_NUMBER_OF_VECTOR_EMBEDDINGS_QUERY = """
+    MATCH (a:abstract) WHERE a.abstractEmbedding IS NOT NULL
+    RETURN count(a) AS num_embeddings
+"""
+
+
+def _species(species_id: int) -> str:
     """
-    # Retrieve all the symbols that correspond to aliases found in names
-    with driver.session() as session:
-        result = session.run(query)
-        symbols_set, aliases_set, mapping, symbol_alias = _convert_to_symbol_alias(
-            result
-        )
-    # To make less calls to the database, remove the aliases and add their corresponding symbol
-    genes_set = set(names)
-    result_names = list(genes_set - aliases_set) + list(symbols_set - genes_set)
-
-    query = f"""
-        MATCH (protein:Protein:{species})
-        WHERE protein.SYMBOL IN {result_names}
-            OR protein.ENSEMBL_PROTEIN IN {result_names}
-        RETURN protein, protein.ENSEMBL_PROTEIN AS id, protein.SYMBOL as symbol
+    :return: the node label of the species
     """
-    with driver.session() as session:
-        result = session.run(query)
-        protein, id = _convert_to_protein_id(result, symbol_alias)
-        return protein, id, mapping
+    if species_id not in _SPECIES:
+        raise ValueError(f"Unknown species: {species_id}")
+    return _SPECIES[species_id]
 
 
-def get_protein_neighbours(
-    driver: neo4j.Driver, protein_ids: list[str], threshold: int, species_id: int
-) -> Tuple[List[str], List[str], List[str], List[Union[int, float]]]:
-    """
-    :returns: proteins, source_ids, target_ids, scores
+def get_proteins_for_ids(
+    driver: neo4j.Driver, protein_ids: list[str], species_id: int
+) -> Tuple[list, list[str]]:
     """
-    if species_id == 10090:
-        species = "Mus_Musculus"
-    elif species_id == 9606:
-        species = "Homo_Sapiens"
-
-    # unsafe parameters because otherwise this query takes 10s with neo4j for unknown reasons
-    query = f"""
-        MATCH (source:Protein:{species})-[association:STRING]->(target:Protein:{species})
-        WHERE source.ENSEMBL_PROTEIN IN {protein_ids}
-            AND target.ENSEMBL_PROTEIN IN {protein_ids}
-            AND association.combined >= {threshold}
-        RETURN source, target, association.combined AS score
+    :returns: protein nodes and their ids
     """
-
+    query = _PROTEINS_FOR_IDS_QUERY.format(species=_species(species_id))
     with driver.session() as session:
-        result = session.run(query)
-        return _convert_to_connection_info_score(result=result, _int=True, protein=True)
+        result = session.run(query, protein_ids=protein_ids)
+        return _convert_to_protein_id(result)
 
 
 def get_protein_associations(
     driver: neo4j.Driver, protein_ids: list[str], threshold: int, species_id: int
-) -> Tuple[List[str], List[str], List[str], List[Union[int, float]]]:
-    """
-    :returns: proteins (nodes), source_ids, target_ids, score
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    if species_id == 10090:
-        species = "Mus_Musculus"
-    elif species_id == 9606:
-        species = "Homo_Sapiens"
-
-    # unsafe parameters are needed because otherwise this query takes 10s with neo4j for unknown reasons
-    query = f"""
-        MATCH (source:Protein:{species})-[association:STRING]->(target:Protein:{species})
-        WHERE source.ENSEMBL_PROTEIN IN {protein_ids}
-            AND target.ENSEMBL_PROTEIN IN {protein_ids}
-            AND association.Score >= {threshold}
-        RETURN source, target, association.Score AS score
+    :returns: source_ids, target_ids, scores (see `get_proteins_for_ids` for the nodes)
     """
+    query = _PROTEIN_ASSOCIATIONS_QUERY.format(species=_species(species_id))
     with driver.session() as session:
-        result = session.run(query)
-        return _convert_to_connection_info_score(result=result, _int=True, protein=True)
-
+        result = session.run(query, protein_ids=protein_ids, threshold=threshold)
+        return _convert_to_edge_columns(result.values("source", "target", "score"))
 
-def get_enrichment_terms(driver: neo4j.Driver, species_id: int) -> list[dict[str, Any]]:
-    if species_id == 10090:
-        species = "Mus_Musculus"
-    elif species_id == 9606:
-        species = "Homo_Sapiens"
 
-    query = f"""
-        MATCH (term:FT:{species})
-        RETURN term.Term AS id, split(term.Term, "~")[0] as clean, term.Name AS name, term.Category AS category, term.Symbols AS symbols
+def get_string_network(
+    driver: neo4j.Driver, species_id: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
-
-    with driver.session() as session:
-        result = session.run(query).data()
-        driver.close()
-        return result
-
-
-def get_number_of_genes(driver: neo4j.Driver, species_id: int) -> int:
-    if species_id == 10090:
-        species = "Mus_Musculus"
-    elif species_id == 9606:
-        species = "Homo_Sapiens"
-
-    query = f"""
-        MATCH (n:TG:{species})
-        RETURN count(n) AS num_genes
+    :returns: source_ids, target_ids, scores and combined scores of every STRING edge,
+        missing scores are -1
     """
+    query = _STRING_NETWORK_QUERY.format(species=_species(species_id))
+    source, target, score, combined = [], [], [], []
     with driver.session() as session:
         result = session.run(query)
-        num_genes = result.single(strict=True)["num_genes"]
-        driver.close()
-        return int(num_genes)
+        for row in result.values("source", "target", "score", "combined"):
+            source.append(row[0])
+            target.append(row[1])
+            score.append(row[2])
+            combined.append(row[3])
+    return (
+        np.array(source, dtype=object),
+        np.array(target, dtype=object),
+        np.array(score, dtype=np.int32),
+        np.array(combined, dtype=np.int32),
+    )
 
 
 def _convert_to_protein_id(
-    result: neo4j.Result, symbol_alias: dict
+    result: Union[neo4j.Result, List[neo4j.Record]]
 ) -> Tuple[list, list[str]]:
     proteins, ids = list(), list()
     for row in result:
@@ -186,96 +194,179 @@ def _convert_to_protein_id(
     return proteins, ids
 
 
-def _convert_to_symbol_alias(
-    result: neo4j.Result,
-) -> Tuple[Set[str], Set[str], Dict[str, str], Dict[str, str]]:
-    symbols = set()
-    aliases = set()
-    symbol_aliases = {}
-    mapping = {}
-    for row in result:
-        symbol = row["symbol"]
-        alias = row["found_alias"]
-        symbol_aliases[symbol] = row["found_alias"]
-        symbols.add(symbol)
-        aliases.add(alias)
-        # Only add the (symbol: alias) if the symbol isnt there already
-        if row["symbol"] not in mapping:
-            mapping[symbol] = alias
-    return symbols, aliases, mapping, symbol_aliases
-
-
-def _convert_to_connection_info_score(
-    result: neo4j.Result, _int: bool, protein: bool
-) -> Tuple[List[str], List[str], List[str], List[Union[int, float]]]:
-    nodes: List[str] = []
-    source: List[str] = []
-    target: List[str] = []
-    score: List[Union[int, float]] = []
-
-    for row in result:
-        nodes.append(row["source"])
-        nodes.append(row["target"])
-        if protein:
-            source.append(row["source"].get("ENSEMBL_PROTEIN"))
-            target.append(row["target"].get("ENSEMBL_PROTEIN"))
-        else:
-            source.append(row["source"].get("Term"))
-            target.append(row["target"].get("Term"))
-        if _int:
-            score.append(int(row["score"]))
-        else:
-            score.append(float(row["score"]))
-
-    return nodes, source, target, score
+def _convert_to_edge_columns(
+    rows: List[list],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :param rows: (source, target, score) values of the records
+    :returns: source and target ids (object arrays) and integer scores of the edges
+    """
+    source, target, score = [], [], []
+    for row_source, row_target, row_score in rows:
+        source.append(row_source)
+        target.append(row_target)
+        score.append(row_score)
+    return (
+        np.array(source, dtype=object),
+        np.array(target, dtype=object),
+        np.array(score, dtype=np.int64),
+    )
 
 
 def get_abstracts(driver, species, query: list) -> list:
-    neo4j_query = f"""
-        MATCH (n:TG:{species})-[:REFERENCES]->(a:abstract)
-        WHERE n.SYMBOL in {query}
-        WITH percentileCont(a.times_cited, 0.85) AS top_15_threshold, count(a) as total_abstracts
-
-        // Case 1: More than 2000 abstracts are returned. Take the top 15% and limit to 2000 hits
-        MATCH (n:TG:{species})-[:REFERENCES]->(a:abstract)
-        WHERE total_abstracts >= 2000 AND n.SYMBOL in {query} AND a.times_cited >= top_15_threshold
-        RETURN DISTINCT a.PMID AS PMID,
-        a.abstract AS abstract,
-        a.title AS title,
-        a.times_cited AS times_cited,
-        a.published AS published,
-        a.cited_by AS citations
-        ORDER BY a.times_cited DESC LIMIT 2000
-        UNION
-
-        // Case 2: Less than 2000 abstracts are returned. Return all abstracts
-        MATCH (n:TG:{species})-[:REFERENCES]->(a:abstract)
-        WHERE n.SYMBOL in {query}
-        WITH count(a) as total_abstracts
-
-        MATCH (n:TG:{species})-[:REFERENCES]->(a:abstract)
-        WHERE total_abstracts < 2000 AND n.SYMBOL in {query}
-        RETURN DISTINCT a.PMID AS PMID,
-        a.abstract AS abstract,
-        a.title AS title,
-        a.times_cited AS times_cited,
-        a.published AS published,
-        a.cited_by AS citations
-        """
+    if species not in _SPECIES.values():
+        raise ValueError(f"Unknown species: {species}")
+    neo4j_query = _ABSTRACTS_QUERY.format(species=species)
     with driver.session() as session:
-        result = session.run(neo4j_query).data()
-        driver.close()
+        result = session.run(neo4j_query, query=query).data()
         return result
 
 
 def fetch_vector_embeddings(driver, pmids: list) -> list:
     stopwatch = Stopwatch()
-    neo4j_query = f"""
-    MATCH (a:abstract) where a.PMID in {pmids}
-    RETURN DISTINCT a.PMID as PMID, a.abstractEmbedding as abstractEmbedding
-    """
     with driver.session() as session:
-        result = session.run(neo4j_query).data()
-        driver.close()
+        result = session.run(_VECTOR_EMBEDDINGS_QUERY, pmids=pmids).data()
         stopwatch.round("Fetching embeddings")
         return result
+
+
+def get_number_of_vector_embeddings(driver) -> int:
+    with driver.session() as session:
+        result = session.run(_NUMBER_OF_VECTOR_EMBEDDINGS_QUERY)
+        return int(result.single(strict=True)["num_embeddings"])
+
+
+def iter_vector_embeddings(driver) -> Iterator[Tuple[str, list[float]]]:
+    """
+    Stream (PMID, embedding) of every abstract, for building the vector index offline
+    """
+    with driver.session() as session:
+        for row in session.run(_ALL_VECTOR_EMBEDDINGS_QUERY):
+            yield str(row["PMID"]), row["abstractEmbedding"]
+
+
+# Async queries, independent ones run concurrently, see `database.gather`
+
+
+async def _fetch_async(driver: neo4j.AsyncDriver, query: str, **parameters) -> list:
+    async with driver.session() as session:
+        result = await session.run(query, **parameters)
+        return [record async for record in result]
+
+
+async def get_number_of_genes_async(driver: neo4j.AsyncDriver, species_id: int) -> int:
+    query = _NUMBER_OF_GENES_QUERY.format(species=_species(species_id))
+    records = await _fetch_async(driver, query)
+    return int(records[0]["num_genes"])
+
+
+async def get_enrichment_terms_async(
+    driver: neo4j.AsyncDriver, species_id: int
+) -> list[dict[str, Any]]:
+    query = _ENRICHMENT_TERMS_QUERY.format(species=_species(species_id))
+    return [record.data() for record in await _fetch_async(driver, query)]
+
+
+async def get_gene_aliases_async(
+    driver: neo4j.AsyncDriver, species_id: int
+) -> list[dict[str, Any]]:
+    """
+    :returns: symbol and aliases (JSON list) of every gene that has aliases
+    """
+    query = _GENE_ALIASES_QUERY.format(species=_species(species_id))
+    return [record.data() for record in await _fetch_async(driver, query)]
+
+
+async def get_protein_names_async(
+    driver: neo4j.AsyncDriver, species_id: int
+) -> list[dict[str, Any]]:
+    """
+    :returns: ENSEMBL protein id, symbol and ENSEMBL gene id of every protein
+    """
+    query = _PROTEIN_NAMES_QUERY.format(species=_species(species_id))
+    return [record.data() for record in await _fetch_async(driver, query)]
+
+
+async def get_proteins_for_ids_async(
+    driver: neo4j.AsyncDriver, protein_ids: list[str], species_id: int
+) -> Tuple[list, list[str]]:
+    query = _PROTEINS_FOR_IDS_QUERY.format(species=_species(species_id))
+    records = await _fetch_async(driver, query, protein_ids=protein_ids)
+    return _convert_to_protein_id(records)
+
+
+async def get_protein_neighbours_async(
+    driver: neo4j.AsyncDriver, protein_ids: list[str], threshold: int, species_id: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :returns: source_ids, target_ids, scores (see `get_proteins_for_ids` for the nodes)
+    """
+    query = _PROTEIN_NEIGHBOURS_QUERY.format(species=_species(species_id))
+    records = await _fetch_async(
+        driver, query, protein_ids=protein_ids, threshold=threshold
+    )
+    return _convert_to_edge_columns(
+        [record.values("source", "target", "score") for record in records]
+    )
+
+
+async def get_protein_associations_async(
+    driver: neo4j.AsyncDriver, protein_ids: list[str], threshold: int, species_id: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    query = _PROTEIN_ASSOCIATIONS_QUERY.format(species=_species(species_id))
+    records = await _fetch_async(
+        driver, query, protein_ids=protein_ids, threshold=threshold
+    )
+    return _convert_to_edge_columns(
+        [record.values("source", "target", "score") for record in records]
+    )
+
+
+async def get_induced_edges_sharded_async(
+    driver: neo4j.AsyncDriver,
+    protein_ids: list[str],
+    threshold: int,
+    species_id: int,
+    combined: bool = False,
+    block_size: int = 1000,
+    concurrency: int = 8,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Induced STRING edges of a large id list, for lists too large for one query.
+
+    The ids are split into blocks of `block_size` and every (source block,
+    target block) pair is one query, at most `concurrency` of them run at once
+    on the connection pool. Duplicate ids are dropped first, so the pairs
+    partition the edges and the merged result has no duplicate edges.
+
+    :param combined: filter and score by `combined` like `get_protein_neighbours_async`,
+        else by `Score` like `get_protein_associations`
+    :returns: source_ids, target_ids, scores
+    """
+    template = (
+        _PROTEIN_NEIGHBOURS_BLOCK_QUERY
+        if combined
+        else _PROTEIN_ASSOCIATIONS_BLOCK_QUERY
+    )
+    query = template.format(species=_species(species_id))
+    ids = list(dict.fromkeys(protein_ids))
+    blocks = [
+        ids[start : start + block_size] for start in range(0, len(ids), block_size)
+    ]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_block_pair(source_ids: list[str], target_ids: list[str]) -> list:
+        async with semaphore:
+            records = await _fetch_async(
+                driver,
+                query,
+                source_ids=source_ids,
+                target_ids=target_ids,
+                threshold=threshold,
+            )
+        return [record.values("source", "target", "score") for record in records]
+
+    parts = await asyncio.gather(
+        *(fetch_block_pair(source, target) for source in blocks for target in blocks)
+    )
+    return _convert_to_edge_columns([row for part in parts for row in part])
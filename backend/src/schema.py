@@ -0,0 +1,111 @@
+"""
+Indexes and constraints the queries of `queries.py` depend on.
+
+`create_schema` creates every declared index and constraint that does not
+exist yet. `verify_query_plans` runs `EXPLAIN` on every query template of
+`queries.py` for every species and raises if a query plans a label or
+all-nodes scan, unless the query is listed in `queries.FULL_SCAN_QUERIES`.
+Both run at server startup (disable with `NEO4J_SCHEMA_CHECK=false`).
+"""
+
+import re
+from typing import Iterator
+
+import neo4j
+import queries
+
+# (name, label, property), node property indexes are shared by all species labels
+INDEXES = [
+    ("protein_ensembl_protein", "Protein", "ENSEMBL_PROTEIN"),
+    ("protein_symbol", "Protein", "SYMBOL"),
+    ("ft_term", "FT", "Term"),
+    ("gene_index", "TG", "SYMBOL"),
+]
+
+# (name, label, property) that have to be unique
+UNIQUE_CONSTRAINTS = [
+    ("abstract_pmid", "abstract", "PMID"),
+]
+
+# Plan operators that read every node of a label or of the graph
+_SCAN_OPERATORS = ("NodeByLabelScan", "AllNodesScan")
+_PARAMETER = re.compile(r"\$(\w+)")
+
+
+class QueryPlanError(RuntimeError):
+    """
+    A query of `queries.py` plans a scan instead of an index lookup.
+    """
+
+
+def schema_statements() -> list[str]:
+    """
+    :return: idempotent Cypher statements creating the declared schema
+    """
+    statements = [
+        f"CREATE INDEX {name} IF NOT EXISTS FOR (n:{label}) ON (n.{prop})"
+        for name, label, prop in INDEXES
+    ]
+    statements += [
+        f"CREATE CONSTRAINT {name} IF NOT EXISTS FOR (n:{label}) REQUIRE n.{prop} IS UNIQUE"
+        for name, label, prop in UNIQUE_CONSTRAINTS
+    ]
+    return statements
+
+
+def create_schema(driver: neo4j.Driver):
+    """
+    Create the declared indexes and constraints that do not exist yet and wait
+    until all indexes are online.
+    """
+    with driver.session() as session:
+        for statement in schema_statements():
+            session.run(statement).consume()
+        session.run("CALL db.awaitIndexes(300)").consume()
+
+
+def query_templates() -> Iterator[tuple[str, str]]:
+    """
+    :return: (name, Cypher) of every query of `queries.py`, formatted for every species
+    """
+    for name, template in vars(queries).items():
+        if not (name.endswith("_QUERY") and isinstance(template, str)):
+            continue
+        if "{species}" not in template:
+            yield name, template
+            continue
+        for species in queries._SPECIES.values():
+            yield f"{name} ({species})", template.format(species=species)
+
+
+def _scans(plan: dict) -> Iterator[str]:
+    """
+    :return: descriptions of the scan operators in a plan tree
+    """
+    if plan["operatorType"].startswith(_SCAN_OPERATORS):
+        details = plan.get("args", {}).get("Details", "")
+        yield f"{plan['operatorType']} {details}".strip()
+    for child in plan.get("children", []):
+        yield from _scans(child)
+
+
+def verify_query_plans(driver: neo4j.Driver):
+    """
+    EXPLAIN every query of `queries.py` (nothing is executed).
+
+    :raises QueryPlanError: listing all queries that plan a label or all-nodes scan
+    """
+    problems = []
+    with driver.session() as session:
+        for name, query in query_templates():
+            if name.split(" ")[0] in queries.FULL_SCAN_QUERIES:
+                continue
+            parameters = {key: None for key in _PARAMETER.findall(query)}
+            plan = session.run(f"EXPLAIN {query}", parameters).consume().plan
+            if plan:
+                problems += [f"{name}: {scan}" for scan in _scans(plan)]
+    if problems:
+        raise QueryPlanError(
+            "Queries plan a scan, check the indexes in schema.py:\n"
+            + "\n".join(problems)
+        )
@@ -0,0 +1,296 @@
+"""
+Local engine for STRING association lookups.
+
+Every protein subgraph request asks Neo4j for the STRING edges induced by
+the requested proteins. The engine answers these lookups from a compressed
+sparse row (CSR) copy of the network of a species, written once by
+`python string_graph.py --species <id>` and memory-mapped from disk, so that
+all server and worker processes share one copy through the page cache.
+A build is written to a new directory that replaces the old one, so a build
+written while the server runs, a rebuild included, is opened on the next
+lookup without disturbing the mappings of the previous build.
+
+The engine is optional: without a built network for the species, or if it
+was built from an older data release, the lookups go to Neo4j. Id lists
+longer than `STRING_SHARD_THRESHOLD` (default 2000) are then split into
+blocks of `STRING_SHARD_SIZE` ids (default 1000) whose block pairs are
+queried concurrently, at most `STRING_SHARD_CONCURRENCY` (default 8) at once,
+see `queries.get_induced_edges_sharded_async`.
+
+Files in `STRING_GRAPH_DIR/<species_id>/` (default: `string_graph/` next to this file):
+- `ids.npy`: sorted ENSEMBL protein ids, row `i` of the CSR describes protein `ids[i]`
+- `indptr.npy`, `indices.npy`: outgoing edges, targets of protein `i` are
+  `indices[indptr[i]:indptr[i + 1]]` (sorted)
+- `score.npy`, `combined.npy`: `Score` and `combined` of every edge, -1 if missing
+- `version.txt`: data release the files were built from
+"""
+
+import argparse
+import os
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+import database
+import neo4j
+import numpy as np
+import queries
+from dotenv import load_dotenv
+from term_store import release_version
+from util.atomic_dir import build_stamp, replace_directory
+from util.sorted_rows import sorted_rows
+from util.stopwatch import Stopwatch
+
+# Load .env file
+load_dotenv()
+
+_SCRIPT_DIR = os.path.dirname(__file__)
+_GRAPH_DIR = os.getenv("STRING_GRAPH_DIR", os.path.join(_SCRIPT_DIR, "string_graph"))
+_ARRAYS = ["ids", "indptr", "indices", "score", "combined"]
+_SHARD_THRESHOLD = int(os.getenv("STRING_SHARD_THRESHOLD", "2000"))
+_SHARD_SIZE = int(os.getenv("STRING_SHARD_SIZE", "1000"))
+_SHARD_CONCURRENCY = int(os.getenv("STRING_SHARD_CONCURRENCY", "8"))
+
+# Opened networks with the stamp of the build they were opened from (see
+# `_build_stamp`), None marks species without an up-to-date network on disk
+_graphs: Dict[int, Tuple[Optional["StringGraph"], Optional[Tuple[int, int]]]] = {}
+_lock = threading.Lock()
+
+
+class StringGraph:
+    """
+    STRING network of one species as CSR arrays, see the module docstring
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        score: np.ndarray,
+        combined: np.ndarray,
+        version: str,
+    ):
+        self.ids = ids
+        self.indptr = indptr
+        self.indices = indices
+        self.score = score
+        self.combined = combined
+        self.version = version
+
+    @classmethod
+    def open(cls, species_id: int) -> Optional["StringGraph"]:
+        """
+        :return: the memory-mapped network of the species, None if it is missing or outdated
+        """
+        directory = os.path.join(_GRAPH_DIR, str(species_id))
+        version_file = _version_file(species_id)
+        if not os.path.exists(version_file):
+            return None
+        with open(version_file) as f:
+            version = f.read().strip()
+        if version != release_version():
+            return None
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            for name in _ARRAYS
+        }
+        return cls(version=version, **arrays)
+
+    @classmethod
+    def build(
+        cls,
+        source: np.ndarray,
+        target: np.ndarray,
+        score: np.ndarray,
+        combined: np.ndarray,
+        version: str,
+    ) -> "StringGraph":
+        """
+        Build the CSR arrays from an edge list.
+        """
+        ids, inverse = np.unique(
+            np.concatenate((source, target)).astype(str), return_inverse=True
+        )
+        rows, cols = np.split(inverse.astype(np.int32), 2)
+        order = np.lexsort((cols, rows))
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(ids)), out=indptr[1:])
+        return cls(
+            ids,
+            indptr,
+            cols[order],
+            score[order].astype(np.int32),
+            combined[order].astype(np.int32),
+            version,
+        )
+
+    def save(self, directory: str):
+        """
+        Write the network to `directory`, replacing a previous build as a whole.
+        """
+        with replace_directory(directory) as build:
+            for name in _ARRAYS:
+                np.save(os.path.join(build, f"{name}.npy"), getattr(self, name))
+            with open(os.path.join(build, "version.txt"), "w") as f:
+                f.write(self.version)
+
+    def rows(self, protein_ids: Iterable[str]) -> np.ndarray:
+        """
+        :return: sorted rows of the given proteins, unknown ids are skipped
+        """
+        return sorted_rows(self.ids, protein_ids)
+
+    def induced_edges(
+        self, protein_ids: list[str], threshold: int, combined: bool = False
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Edges between the given proteins with a score of at least `threshold`.
+
+        :param combined: filter and return the `combined` instead of the `Score` value
+        :returns: source_ids, target_ids, scores (same as `queries.get_protein_associations`)
+        """
+        rows = self.rows(protein_ids)
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        lengths = ends - starts
+        # Concatenate the adjacency lists of all rows without a Python loop
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions = offsets + np.arange(lengths.sum())
+        sources = np.repeat(rows, lengths)
+        targets = self.indices[positions]
+        scores = (self.combined if combined else self.score)[positions]
+
+        member = np.zeros(len(self.ids), dtype=bool)
+        member[rows] = True
+        keep = member[targets] & (scores >= threshold)
+        return (
+            self.ids[sources[keep]].astype(object),
+            self.ids[targets[keep]].astype(object),
+            scores[keep].astype(np.int64),
+        )
+
+
+def get_string_graph(species_id: int) -> Optional[StringGraph]:
+    """
+    :return: the network of the species, None if there is no up-to-date build on disk,
+        a new build is opened on the next call
+    """
+    cached = _graphs.get(species_id)
+    if cached is not None:
+        graph, built = cached
+        if built == _build_stamp(species_id) and (
+            graph is None or graph.version == release_version()
+        ):
+            return graph
+    with _lock:
+        return _open(species_id)
+
+
+def refresh(species_id: Optional[int] = None):
+    """
+    Reopen the network of one species, or of every opened species if `species_id` is None.
+    """
+    with _lock:
+        species = list(_graphs) if species_id is None else [species_id]
+        for species_id in species:
+            _open(species_id)
+
+
+def _open(species_id: int) -> Optional[StringGraph]:
+    built = _build_stamp(species_id)
+    graph = StringGraph.open(species_id)
+    _graphs[species_id] = (graph, built)
+    return graph
+
+
+def _version_file(species_id: int) -> str:
+    return os.path.join(_GRAPH_DIR, str(species_id), "version.txt")
+
+
+def _build_stamp(species_id: int) -> Optional[Tuple[int, int]]:
+    """
+    :return: stamp of the version file of the current build, None if there is none
+    """
+    return build_stamp(_version_file(species_id))
+
+
+async def _get_induced_edges_sharded(
+    driver: neo4j.AsyncDriver,
+    protein_ids: list[str],
+    threshold: int,
+    species_id: int,
+    combined: bool = False,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    return await queries.get_induced_edges_sharded_async(
+        driver,
+        protein_ids,
+        threshold,
+        species_id,
+        combined=combined,
+        block_size=_SHARD_SIZE,
+        concurrency=_SHARD_CONCURRENCY,
+    )
+
+
+async def get_protein_associations_async(
+    driver: neo4j.AsyncDriver, protein_ids: list[str], threshold: int, species_id: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :returns: source_ids, target_ids, score, from the local network if available,
+        else from Neo4j (see `database.gather`)
+    """
+    graph = get_string_graph(species_id)
+    if graph is not None:
+        return graph.induced_edges(protein_ids, threshold)
+    if len(protein_ids) > _SHARD_THRESHOLD:
+        return await _get_induced_edges_sharded(
+            driver, protein_ids, threshold, species_id
+        )
+    return await queries.get_protein_associations_async(
+        driver, protein_ids, threshold, species_id
+    )
+
+
+async def get_protein_neighbours_async(
+    driver: neo4j.AsyncDriver, protein_ids: list[str], threshold: int, species_id: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :returns: source_ids, target_ids, scores (`combined`), from the local network if
+        available, else from Neo4j (see `database.gather`)
+    """
+    graph = get_string_graph(species_id)
+    if graph is not None:
+        return graph.induced_edges(protein_ids, threshold, combined=True)
+    if len(protein_ids) > _SHARD_THRESHOLD:
+        return await _get_induced_edges_sharded(
+            driver, protein_ids, threshold, species_id, combined=True
+        )
+    return await queries.get_protein_neighbours_async(
+        driver, protein_ids, threshold, species_id
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the local STRING network of a species from Neo4j"
+    )
+    parser.add_argument("--species", type=int, default=10090)
+    args = parser.parse_args()
+
+    stopwatch = Stopwatch()
+    driver = database.init_driver()
+    try:
+        source, target, score, combined = queries.get_string_network(
+            driver, args.species
+        )
+    finally:
+        database.close_driver()
+    stopwatch.round("Fetching edges")
+
+    graph = StringGraph.build(source, target, score, combined, release_version())
+    graph.save(os.path.join(_GRAPH_DIR, str(args.species)))
+    stopwatch.round("Building CSR")
+    print(f"{len(graph.ids)} proteins, {len(graph.indices)} edges")
+
+
+if __name__ == "__main__":
+    main()
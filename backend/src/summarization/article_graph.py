@@ -1,3 +1,5 @@
+import os
+import threading
 import time
 from ast import literal_eval
 
@@ -6,39 +8,85 @@ import numpy as np
 from igraph import Graph
 from langchain_ollama.embeddings import OllamaEmbeddings
 from queries import get_abstracts
+from summarization.batcher import MicroBatcher
 from summarization.chat_bot import summarize
+from summarization.vector_index import normalize, top_k
+from util.lru_cache import LRUCache
 from util.stopwatch import Stopwatch
 
+EMBEDDING_MODEL = "llama3.1"
 
-def cosine_similarity(vec1, vec2):
-    """Compute cosine similarity between two vectors."""
-    dot_product = np.dot(vec1, vec2)
-    norm_vec1 = np.linalg.norm(vec1)
-    norm_vec2 = np.linalg.norm(vec2)
-    return dot_product / (norm_vec1 * norm_vec2)
+# One client and one batcher per model for the life of the process
+_embedders: dict[str, OllamaEmbeddings] = {}
+_batchers: dict[str, MicroBatcher] = {}
+_embedders_lock = threading.Lock()
+# (model, normalized query) -> embedding
+query_embeddings = LRUCache(maxsize=int(os.getenv("EMBEDDING_CACHE_SIZE", "1024")))
 
 
-def generate_embedding(query):
-    embedder = OllamaEmbeddings(model="llama3.1")
-    embeddings = embedder.embed_query(query)
-    return embeddings
+def get_embedder(model=EMBEDDING_MODEL):
+    """Return the embedding client of the model, created on first use."""
+    embedder = _embedders.get(model)
+    if embedder is None:
+        with _embedders_lock:
+            embedder = _embedders.get(model)
+            if embedder is None:
+                embedder = OllamaEmbeddings(model=model)
+                _embedders[model] = embedder
+    return embedder
 
 
-def top_n_similar_vectors(input_vector, vectors, n):
-    """Find the top n most similar vectors to the input_vector."""
-    similarities = []
+def get_batcher(model=EMBEDDING_MODEL):
+    """
+    Return the batcher of the model, created on first use. Concurrent queries are
+    embedded together in one embed_documents call.
+    """
+    batcher = _batchers.get(model)
+    if batcher is None:
+        embedder = get_embedder(model)
+        with _embedders_lock:
+            batcher = _batchers.get(model)
+            if batcher is None:
+                batcher = MicroBatcher(
+                    embedder.embed_documents,
+                    max_batch=int(os.getenv("EMBEDDING_BATCH_SIZE", "16")),
+                    max_wait=float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5")) / 1000,
+                    name=f"embedding-batcher-{model}",
+                )
+                _batchers[model] = batcher
+    return batcher
+
+
+def embedding_batch_stats():
+    """Return the batch statistics of every model, see MicroBatcher.stats."""
+    return {model: batcher.stats() for model, batcher in _batchers.items()}
 
-    for vector in vectors:
-        similiars = cosine_similarity(input_vector, vector["abstractEmbedding"])
-        similarities.append((vector["PMID"], similiars))
 
-    # Sort by similarity score in descending order
-    similarities.sort(key=lambda x: x[1], reverse=True)
+def normalize_query(query):
+    """Case and whitespace insensitive form of a query, used as cache key."""
+    return " ".join(str(query).split()).casefold()
+
+
+def generate_embedding(query, model=EMBEDDING_MODEL):
+    key = (model, normalize_query(query))
+    embedding = query_embeddings.get(key)
+    if embedding is None:
+        embedding = get_batcher(model).submit(str(query)).result()
+        query_embeddings.put(key, embedding)
+    return embedding
+
+
+def top_n_similar_vectors(input_vector, vectors, n):
+    """Find the top n most similar vectors to the input_vector."""
+    if not vectors:
+        return []
+    pmids = [vector["PMID"] for vector in vectors]
+    # Cosine similarity of all vectors at once: normalized rows times normalized query
+    matrix = normalize(np.array([vector["abstractEmbedding"] for vector in vectors]))
+    similarities = matrix @ normalize(np.asarray(input_vector)[None, :])[0]
 
-    # Get the top n similar vectors
-    top_n = similarities[:n]
-    top_n = [i[0] for i in top_n]
-    return top_n
+    # Get the top n similar vectors, sorted by similarity in descending order
+    return [pmids[i] for i in top_k(similarities, n)]
 
 
 def citations_pagerank(graph):
@@ -181,7 +229,9 @@ def create_citations_graph(driver, species, search_query):
     return edge_list, nodes
 
 
-def get_most_relevant_abstracts(message, pmids_embeddings, pmid_abstract, protein_list):
+def get_most_relevant_abstracts(
+    message, pmids_embeddings, pmid_abstract, protein_list, index=None
+):
     """
     Using vector search, obtain abstracts most similiar to the input message. These abstracts are summarized to
     then be returned for further processing.
@@ -191,6 +241,7 @@ def get_most_relevant_abstracts(message, pmids_embeddings, pmid_abstract, protei
         pmids_embeddings: dictionary of format {pmid: embedding} of all abstracts to be searched with vector search
         pmid_abstract: dictionary of format {pmid: abstract}
         protein_list: list of proteins to be taken into account in summarization of abstracts
+        index: vector index (see vector_index.py) to search instead of pmids_embeddings
     Returns:
         abstracts: Abstracts obtained from vector search in format list of dictionaries
                     (each dictionary is format: {Abstract <abstract_i> with PMID <pmid>: summarized abstract})
@@ -199,7 +250,10 @@ def get_most_relevant_abstracts(message, pmids_embeddings, pmid_abstract, protei
     stopwatch = Stopwatch()
     embedded_query = generate_embedding(str(message))
     stopwatch.round("Embedding query")
-    top_n_similiar = top_n_similar_vectors(embedded_query, pmids_embeddings, 6)
+    if index is not None:
+        top_n_similiar, _ = index.search(embedded_query, 6, pmids=list(pmid_abstract))
+    else:
+        top_n_similiar = top_n_similar_vectors(embedded_query, pmids_embeddings, 6)
     stopwatch.round("Vector search")
     unsummarized = [
         [pmid_abstract[i] for i in top_n_similiar[j : j + 3]]
@@ -0,0 +1,100 @@
+"""
+Micro-batching of concurrent calls to a batch function.
+
+Requests that arrive within `max_wait` seconds of the first waiting one
+are collected, up to `max_batch`, and passed to the batch function in a
+single call from a background thread. Every caller gets a future of its
+own result. Used to turn concurrent `embed_query` calls into one
+`embed_documents` call.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Hashable
+
+
+class MicroBatcher:
+    """
+    Collects items from concurrent callers and processes them in batches
+
+    - `fn`: called with a list of items, returns a list of results in the same order
+    - `max_batch`: maximal number of items per call of `fn`
+    - `max_wait`: seconds a batch waits for more items after its first item arrived
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[list], list],
+        max_batch: int = 16,
+        max_wait: float = 0.005,
+        name: str = "micro-batcher",
+    ):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Hashable) -> Future:
+        """
+        :return: future of the result of the item
+        """
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # Equal items are processed once
+            futures: dict[Hashable, list[Future]] = {}
+            for item, future in batch:
+                if future.set_running_or_notify_cancel():
+                    futures.setdefault(item, []).append(future)
+            if not futures:
+                continue
+            items = list(futures)
+            try:
+                results = self.fn(items)
+                if len(results) != len(items):
+                    raise ValueError(
+                        f"Expected {len(items)} results, got {len(results)}"
+                    )
+            except Exception as e:
+                for waiting in futures.values():
+                    for future in waiting:
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(items)
+            for item, result in zip(items, results):
+                for future in futures[item]:
+                    future.set_result(result)
+
+    def stats(self) -> dict:
+        """
+        :return: number of calls of `fn`, items processed and the mean batch size
+        """
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,257 @@
+"""
+Compressed copies of the embedding store.
+
+The float32 embeddings of the corpus are too large to keep in memory next
+to the other data of every worker. A compressed store keeps the normalized
+embeddings, optionally reduced to fewer dimensions by PCA or a random
+projection, as float16 or as int8 with a scale and offset per dimension
+(scalar quantization). It scores a query against stored rows without
+decompressing them and can replace the embedding store in the vector index.
+
+Build offline (from backend/src), after the embedding store:
+    python -m summarization.compression --dtype int8 [--dimension 512 --projection pca]
+Compare the configurations with benchmark_embeddings.py.
+
+Files in `COMPRESSED_STORE_DIR` (default: `compressed_store/` next to this file):
+- `pmids.npy`: sorted PMIDs, same rows as the embedding store
+- `codes.npy`: (abstracts x dimension) float16 or int8
+- `projection.npy`: (model dimension x dimension) float32, only if reduced
+- `scale.npy`, `offset.npy`: float32 per dimension, only for int8, a row is
+  approximately `codes * scale + offset`
+"""
+
+import argparse
+import os
+import threading
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from summarization.embedding_store import CHUNK, EmbeddingStore, matvec
+from util.atomic_dir import build_stamp, replace_directory
+from util.sorted_rows import sorted_rows
+from util.stopwatch import Stopwatch
+
+# Load .env file
+load_dotenv()
+
+_SCRIPT_DIR = os.path.dirname(__file__)
+_COMPRESSED_DIR = os.getenv(
+    "COMPRESSED_STORE_DIR", os.path.join(_SCRIPT_DIR, "compressed_store")
+)
+DTYPES = {"float16": np.float16, "int8": np.int8}
+PROJECTIONS = ["pca", "random"]
+
+_store: Optional["CompressedStore"] = None
+# Stamp of the build `_store` was opened from, see `util.atomic_dir.build_stamp`
+_built: Optional[Tuple[int, int]] = None
+_loaded = False
+_lock = threading.Lock()
+
+
+class CompressedStore:
+    """
+    Normalized, optionally projected and quantized embeddings, see the module docstring
+    """
+
+    def __init__(
+        self,
+        pmids: np.ndarray,
+        codes: np.ndarray,
+        projection: Optional[np.ndarray] = None,
+        scale: Optional[np.ndarray] = None,
+        offset: Optional[np.ndarray] = None,
+    ):
+        self.pmids = pmids
+        self.codes = codes
+        self.projection = projection
+        self.scale = scale
+        self.offset = offset
+
+    @classmethod
+    def open(cls, directory: str = _COMPRESSED_DIR) -> Optional["CompressedStore"]:
+        """
+        :return: the memory-mapped store, None if it has not been built
+        """
+        if not os.path.exists(os.path.join(directory, "pmids.npy")):
+            return None
+        arrays = {}
+        for name in ["pmids", "codes", "projection", "scale", "offset"]:
+            path = os.path.join(directory, f"{name}.npy")
+            if os.path.exists(path):
+                arrays[name] = np.load(path, mmap_mode="r")
+        return cls(**arrays)
+
+    def __len__(self) -> int:
+        return len(self.pmids)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: size of the codes, the memory needed to keep the store resident
+        """
+        return self.codes.nbytes
+
+    def rows(self, pmids: Iterable[str]) -> np.ndarray:
+        """
+        :return: sorted rows of the given PMIDs, unknown PMIDs are skipped
+        """
+        return sorted_rows(self.pmids, pmids)
+
+    def encode_query(self, query: Iterable[float]) -> np.ndarray:
+        """
+        :return: the query projected like the stored rows and normalized
+        """
+        q = np.asarray(query, dtype=np.float32)
+        if self.projection is not None:
+            q = q @ self.projection
+        return q / max(float(np.linalg.norm(q)), float(np.finfo(np.float32).tiny))
+
+    def scores(self, query: Iterable[float], rows: np.ndarray) -> np.ndarray:
+        """
+        :return: approximate cosine similarity of the query and every given row
+        """
+        q = self.encode_query(query)
+        if self.scale is None:
+            return matvec(self.codes, rows, q)
+        # (codes * scale + offset) @ q without decoding the rows
+        return matvec(self.codes, rows, self.scale * q) + float(self.offset @ q)
+
+
+def fit_projection(
+    sample: np.ndarray, dimension: int, method: str, seed: int = 0
+) -> np.ndarray:
+    """
+    :param sample: normalized embeddings
+    :param method: "pca" (top right singular vectors of the sample, uncentered
+        so that dot products are preserved) or "random" (Gaussian)
+    :return: (model dimension x dimension) projection matrix
+    """
+    if method == "pca":
+        # Eigenvectors of the second moment matrix are the right singular vectors
+        values, vectors = np.linalg.eigh(sample.T.astype(np.float64) @ sample)
+        return vectors[:, np.argsort(values)[::-1][:dimension]].astype(np.float32)
+    if method == "random":
+        rng = np.random.default_rng(seed)
+        return (
+            rng.standard_normal((sample.shape[1], dimension)) / np.sqrt(dimension)
+        ).astype(np.float32)
+    raise ValueError(f"Unknown projection: {method}")
+
+
+def compress(
+    store: EmbeddingStore,
+    directory: str,
+    dtype: str = "float16",
+    dimension: Optional[int] = None,
+    projection: str = "pca",
+    sample: int = 50_000,
+    seed: int = 0,
+) -> CompressedStore:
+    """
+    Write a compressed copy of the store to `directory`, replacing a previous build
+    as a whole.
+
+    :param dtype: "float16" or "int8"
+    :param dimension: reduced dimension, None keeps the model dimension
+    :param projection: method of the reduction, see `fit_projection`
+    :param sample: number of embeddings used to fit the projection and the quantization
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype: {dtype}")
+    stopwatch = Stopwatch()
+
+    def normalized(start: int, stop: int) -> np.ndarray:
+        chunk = np.asarray(store.embeddings[start:stop], dtype=np.float32)
+        norms = np.asarray(store.norms[start:stop], dtype=np.float32)
+        return chunk / np.maximum(norms, np.finfo(np.float32).tiny)[:, None]
+
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(len(store), min(sample, len(store)), False))
+    train = np.asarray(store.embeddings[sample_rows], dtype=np.float32)
+    train /= np.maximum(store.norms[sample_rows], np.finfo(np.float32).tiny)[:, None]
+
+    matrix = None
+    if dimension is not None and dimension < store.dimension:
+        matrix = fit_projection(train, dimension, projection, seed)
+        train = train @ matrix
+        train /= np.maximum(np.linalg.norm(train, axis=1), 1e-12)[:, None]
+
+    scale = offset = None
+    if dtype == "int8":
+        low, high = train.min(axis=0), train.max(axis=0)
+        scale = np.maximum((high - low) / 255, 1e-12).astype(np.float32)
+        offset = (low + 128 * scale).astype(np.float32)
+    stopwatch.round("Fitting compression")
+
+    with replace_directory(directory) as build:
+        if matrix is not None:
+            np.save(os.path.join(build, "projection.npy"), matrix)
+        if scale is not None and offset is not None:
+            np.save(os.path.join(build, "scale.npy"), scale)
+            np.save(os.path.join(build, "offset.npy"), offset)
+        codes = np.lib.format.open_memmap(
+            os.path.join(build, "codes.npy"),
+            "w+",
+            DTYPES[dtype],
+            (len(store), train.shape[1]),
+        )
+        for start in range(0, len(store), CHUNK):
+            chunk = normalized(start, start + CHUNK)
+            if matrix is not None:
+                chunk = chunk @ matrix
+                chunk /= np.maximum(np.linalg.norm(chunk, axis=1), 1e-12)[:, None]
+            if scale is not None:
+                chunk = np.clip(np.rint((chunk - offset) / scale), -128, 127)
+            codes[start : start + CHUNK] = chunk
+        codes.flush()
+        del codes
+        np.save(os.path.join(build, "pmids.npy"), store.pmids)
+    stopwatch.round("Compressing embeddings")
+    compressed = CompressedStore.open(directory)
+    if compressed is None:
+        raise RuntimeError(f"Could not open the compressed store in {directory}")
+    return compressed
+
+
+def get_compressed_store() -> Optional[CompressedStore]:
+    """
+    :return: the compressed store, opened on first use and again after a rebuild,
+        None if it has not been built
+    """
+    global _store, _built, _loaded
+    built = build_stamp(os.path.join(_COMPRESSED_DIR, "pmids.npy"))
+    if _loaded and built == _built:
+        return _store
+    with _lock:
+        if not _loaded or built != _built:
+            _store = CompressedStore.open()
+            _built = built
+            _loaded = True
+        return _store
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a compressed copy of the embedding store"
+    )
+    parser.add_argument("--dtype", choices=list(DTYPES), default="int8")
+    parser.add_argument("--dimension", type=int, default=None)
+    parser.add_argument("--projection", choices=PROJECTIONS, default="pca")
+    parser.add_argument("--sample", type=int, default=50_000)
+    args = parser.parse_args()
+
+    store = EmbeddingStore.open()
+    if store is None:
+        raise SystemExit("Build the embedding store first")
+    compressed = compress(
+        store, _COMPRESSED_DIR, args.dtype, args.dimension, args.projection, args.sample
+    )
+    print(
+        f"{len(compressed)} embeddings, {compressed.codes.shape[1]} dimensions, "
+        f"{compressed.nbytes / 2**20:.1f} MiB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Memory-mapped store of the abstract embeddings.
+
+Embeddings used to come back through Neo4j as lists of floats that were
+deserialized on every request. The store keeps them in one contiguous
+float32 matrix sorted by PMID, opened with `mmap_mode="r"` so that all
+processes share one copy through the page cache and a lookup is a slice
+instead of a conversion.
+
+Build offline (from backend/src), from the gzip CSVs of
+generate_embeddings.py or, without `--csv`, from Neo4j:
+    python -m summarization.embedding_store [--csv "genes_abstract_with_embeddings_part_*.gz"]
+
+A rebuild goes to a temporary directory that is renamed into place at the
+end, running servers keep their mappings of the previous files.
+
+Files in `EMBEDDING_STORE_DIR` (default: `embedding_store/` next to this file):
+- `pmids.npy`: sorted PMIDs, row `i` of the embeddings belongs to `pmids[i]`
+- `embeddings.npy`: (abstracts x dimension) float32 as produced by the model
+- `norms.npy`: float32 euclidean norm of every embedding
+"""
+
+import argparse
+import glob
+import json
+import os
+import threading
+from typing import Iterable, Iterator, Optional, Tuple
+
+import database
+import numpy as np
+import pandas as pd
+import queries
+from dotenv import load_dotenv
+from util.atomic_dir import build_stamp, replace_directory
+from util.sorted_rows import sorted_rows
+from util.stopwatch import Stopwatch
+
+# Load .env file
+load_dotenv()
+
+_SCRIPT_DIR = os.path.dirname(__file__)
+_STORE_DIR = os.getenv(
+    "EMBEDDING_STORE_DIR", os.path.join(_SCRIPT_DIR, "embedding_store")
+)
+# Rows per chunk when processing the whole matrix, bounds the temporary memory
+CHUNK = 65536
+# Rows per block when scoring, small enough for the copied rows to stay in cache
+_BLOCK = 1024
+
+_store: Optional["EmbeddingStore"] = None
+# Stamp of the build `_store` was opened from, see `util.atomic_dir.build_stamp`
+_built: Optional[Tuple[int, int]] = None
+_loaded = False
+_lock = threading.Lock()
+
+
+class EmbeddingStore:
+    """
+    Abstract embeddings keyed by PMID, see the module docstring
+    """
+
+    def __init__(self, pmids: np.ndarray, embeddings: np.ndarray, norms: np.ndarray):
+        self.pmids = pmids
+        self.embeddings = embeddings
+        self.norms = norms
+
+    @classmethod
+    def open(cls, directory: str = _STORE_DIR) -> Optional["EmbeddingStore"]:
+        """
+        :return: the memory-mapped store, None if it has not been built
+        """
+        if not os.path.exists(os.path.join(directory, "norms.npy")):
+            return None
+        return cls(
+            *(
+                np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                for name in ["pmids", "embeddings", "norms"]
+            )
+        )
+
+    def __len__(self) -> int:
+        return len(self.pmids)
+
+    @property
+    def dimension(self) -> int:
+        return self.embeddings.shape[1]
+
+    def rows(self, pmids: Iterable[str]) -> np.ndarray:
+        """
+        :return: sorted rows of the given PMIDs, unknown PMIDs are skipped
+        """
+        return sorted_rows(self.pmids, pmids)
+
+    def scores(self, query: Iterable[float], rows: np.ndarray) -> np.ndarray:
+        """
+        :return: cosine similarity of the query and every given row
+        """
+        q = np.asarray(query, dtype=np.float32)
+        q = q / max(float(np.linalg.norm(q)), float(np.finfo(np.float32).tiny))
+        return matvec(self.embeddings, rows, q) / np.maximum(
+            self.norms[rows], np.finfo(np.float32).tiny
+        )
+
+    def get(self, pmid: str) -> Optional[np.ndarray]:
+        """
+        :return: the embedding of the PMID as a read-only view, None if unknown
+        """
+        rows = self.rows([pmid])
+        return self.embeddings[rows[0]] if len(rows) else None
+
+
+def matvec(matrix: np.ndarray, rows: np.ndarray, vector: np.ndarray) -> np.ndarray:
+    """
+    `matrix[rows] @ vector` in float32, computed in blocks of rows so that a
+    memory-mapped or quantized matrix is never copied or converted as a whole.
+    Runs of consecutive rows are sliced without copying.
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    result = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), _BLOCK):
+        block = rows[start : start + _BLOCK]
+        if len(block) > 1 and np.all(np.diff(block) == 1):
+            values = matrix[block[0] : block[-1] + 1]
+        else:
+            values = matrix[block]
+        result[start : start + len(block)] = (
+            values.astype(np.float32, copy=False) @ vector
+        )
+    return result
+
+
+def write(directory: str, items: Iterable[Tuple[str, list[float]]], count: int):
+    """
+    Write a store from (PMID, embedding) pairs, replacing a previous build as a whole.
+
+    :param count: number of pairs, further pairs are ignored
+    """
+    stopwatch = Stopwatch()
+    with replace_directory(directory) as build:
+        # Stream the embeddings into a scratch matrix, in input order
+        scratch_path = os.path.join(build, "embeddings.unsorted.npy")
+        scratch = None
+        pmids: list[str] = []
+        for pmid, embedding in items:
+            if len(pmids) == count:
+                break
+            if scratch is None:
+                scratch = np.lib.format.open_memmap(
+                    scratch_path, "w+", np.float32, (count, len(embedding))
+                )
+            scratch[len(pmids)] = embedding
+            pmids.append(str(pmid))
+        if scratch is None:
+            raise ValueError("No abstract embeddings found")
+        stopwatch.round("Reading embeddings")
+
+        pmids_array = np.asarray(pmids, dtype=str)
+        order = np.argsort(pmids_array, kind="stable")
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(build, "embeddings.npy"),
+            "w+",
+            np.float32,
+            (len(pmids), scratch.shape[1]),
+        )
+        norms = np.empty(len(pmids), dtype=np.float32)
+        for start in range(0, len(order), CHUNK):
+            chunk = scratch[order[start : start + CHUNK]]
+            embeddings[start : start + CHUNK] = chunk
+            norms[start : start + CHUNK] = np.linalg.norm(chunk, axis=1)
+        embeddings.flush()
+        del scratch
+        os.remove(scratch_path)
+        np.save(os.path.join(build, "pmids.npy"), pmids_array[order])
+        np.save(os.path.join(build, "norms.npy"), norms)
+    stopwatch.round("Sorting embeddings")
+    print(f"{len(pmids)} embeddings of dimension {embeddings.shape[1]}")
+
+
+def read_csv_embeddings(files: list[str]) -> Iterator[Tuple[str, list[float]]]:
+    """
+    Stream (PMID, embedding) from the gzip CSVs written by generate_embeddings.py
+    """
+    for file in files:
+        for chunk in pd.read_csv(file, usecols=["PMID", "embeddings"], chunksize=10000):
+            for pmid, embedding in zip(chunk["PMID"], chunk["embeddings"]):
+                yield str(pmid), json.loads(embedding)
+
+
+def count_csv_embeddings(files: list[str]) -> int:
+    return sum(
+        len(chunk)
+        for file in files
+        for chunk in pd.read_csv(file, usecols=["PMID"], chunksize=100000)
+    )
+
+
+def get_embedding_store() -> Optional[EmbeddingStore]:
+    """
+    :return: the store, opened on first use and again after a rebuild, None if it
+        has not been built
+    """
+    global _store, _built, _loaded
+    built = build_stamp(os.path.join(_STORE_DIR, "norms.npy"))
+    if _loaded and built == _built:
+        return _store
+    with _lock:
+        if not _loaded or built != _built:
+            _store = EmbeddingStore.open()
+            _built = built
+            _loaded = True
+        return _store
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the embedding store from the embedding CSVs or Neo4j"
+    )
+    parser.add_argument("--csv", help="glob of the CSVs of generate_embeddings.py")
+    args = parser.parse_args()
+
+    if args.csv:
+        files = sorted(glob.glob(args.csv))
+        write(_STORE_DIR, read_csv_embeddings(files), count_csv_embeddings(files))
+        return
+
+    driver = database.init_driver()
+    try:
+        write(
+            _STORE_DIR,
+            queries.iter_vector_embeddings(driver),
+            queries.get_number_of_vector_embeddings(driver),
+        )
+    finally:
+        database.close_driver()
+
+
+if __name__ == "__main__":
+    main()
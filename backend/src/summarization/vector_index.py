@@ -0,0 +1,233 @@
+"""
+Approximate nearest neighbour index over the abstract embeddings.
+
+The chatbot used to pull the raw embeddings of the selected abstracts from
+Neo4j on every message. The index is an inverted file (IVF-flat) over the
+embedding store: the embeddings are clustered by spherical k-means and a
+search scores only the embeddings of the `nprobe` clusters whose centroids
+are closest to the query. A search restricted to given PMIDs scores exactly
+these embeddings.
+
+Build offline (from backend/src), after the embedding store:
+    python -m summarization.vector_index
+The server opens the index on the first search and opens it again once the
+index or the store under it has been rebuilt.
+
+Files in `VECTOR_INDEX_DIR` (default: `vector_index/` next to this file):
+- `centroids.npy`: (lists x dimension) float32, normalized cluster centroids
+- `list_ptr.npy`, `list_rows.npy`: store rows of cluster `c` are `list_rows[list_ptr[c]:list_ptr[c + 1]]`
+"""
+
+import argparse
+import os
+import threading
+from typing import Iterable, Optional, Tuple, Union
+
+import numpy as np
+from dotenv import load_dotenv
+from summarization.compression import CompressedStore, get_compressed_store
+from summarization.embedding_store import CHUNK, EmbeddingStore, get_embedding_store
+from util.atomic_dir import build_stamp, replace_directory
+from util.stopwatch import Stopwatch
+
+# Load .env file
+load_dotenv()
+
+_SCRIPT_DIR = os.path.dirname(__file__)
+_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", os.path.join(_SCRIPT_DIR, "vector_index"))
+_ARRAYS = ["centroids", "list_ptr", "list_rows"]
+
+_index: Optional["VectorIndex"] = None
+# Store and stamp of the build `_index` was opened from, see `util.atomic_dir.build_stamp`
+_built: Optional[
+    Tuple[Union[EmbeddingStore, CompressedStore, None], Optional[Tuple[int, int]]]
+] = None
+_lock = threading.Lock()
+
+
+class VectorIndex:
+    """
+    IVF-flat index over the embedding store, see the module docstring
+
+    The lists can be searched in a compressed copy of the store (compression.py),
+    its rows are the same.
+    """
+
+    def __init__(
+        self,
+        store: Union[EmbeddingStore, CompressedStore],
+        centroids: np.ndarray,
+        list_ptr: np.ndarray,
+        list_rows: np.ndarray,
+    ):
+        self.store = store
+        self.centroids = centroids
+        self.list_ptr = list_ptr
+        self.list_rows = list_rows
+
+    @classmethod
+    def open(
+        cls,
+        store: Union[EmbeddingStore, CompressedStore],
+        directory: str = _INDEX_DIR,
+    ) -> Optional["VectorIndex"]:
+        """
+        :return: the memory-mapped index over the store, None if it has not been built
+        """
+        if not os.path.exists(os.path.join(directory, "list_rows.npy")):
+            return None
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            for name in _ARRAYS
+        }
+        return cls(store, **arrays)
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """
+        :return: rows of the `nprobe` clusters closest to the (normalized) query
+        """
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(self.centroids @ query, -nprobe)[-nprobe:]
+        return np.concatenate(
+            [
+                self.list_rows[self.list_ptr[c] : self.list_ptr[c + 1]]
+                for c in np.sort(probes)
+            ]
+        )
+
+    def search(
+        self,
+        query: Iterable[float],
+        k: int,
+        pmids: Optional[Iterable[str]] = None,
+        nprobe: int = 16,
+    ) -> Tuple[list[str], np.ndarray]:
+        """
+        :param pmids: only search these abstracts (exact), else the whole corpus (approximate)
+        :param nprobe: number of clusters that are searched
+        :return: PMIDs and cosine similarities of the `k` most similar abstracts, best first
+        """
+        q = normalize(np.asarray(query, dtype=np.float32)[None, :])[0]
+        store = self.store
+        rows = store.rows(pmids) if pmids is not None else self.candidates(q, nprobe)
+        scores = store.scores(query, rows)
+        top = top_k(scores, k)
+        return store.pmids[rows[top]].tolist(), scores[top]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    :return: the rows scaled to unit length as float32, zero rows stay zero
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    :return: positions of the `k` highest scores, highest first, empty if `k` < 1
+    """
+    if k < 1:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(scores, -k)[-k:]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """
+    :return: closest (highest cosine) centroid of every vector
+    """
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), CHUNK):
+        chunk = np.asarray(vectors[start : start + CHUNK], dtype=np.float32)
+        labels[start : start + CHUNK] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def train_centroids(
+    vectors: np.ndarray,
+    num_lists: int,
+    iterations: int = 10,
+    sample: int = 100_000,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Spherical k-means on a random sample of the vectors.
+
+    :return: (num_lists x dimension) normalized centroids
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(vectors), min(sample, len(vectors)), replace=False))
+    train = normalize(vectors[rows])
+    centroids = train[rng.choice(len(train), num_lists, replace=False)]
+    for _ in range(iterations):
+        labels = assign(train, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, train)
+        # Empty clusters keep their previous centroid
+        empty = np.bincount(labels, minlength=num_lists) == 0
+        sums[empty] = centroids[empty]
+        centroids = normalize(sums)
+    return centroids
+
+
+def build(store: EmbeddingStore, directory: str, num_lists: int, iterations: int):
+    """
+    Write the index over all embeddings of the store to `directory`, replacing a
+    previous build as a whole.
+    """
+    stopwatch = Stopwatch()
+    centroids = train_centroids(
+        store.embeddings, min(num_lists, len(store)), iterations
+    )
+    # The norm does not change the closest centroid, raw embeddings are assigned
+    labels = assign(store.embeddings, centroids)
+    list_rows = np.argsort(labels, kind="stable").astype(np.int64)
+    list_ptr = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=len(centroids)), out=list_ptr[1:])
+    with replace_directory(directory) as build:
+        np.save(os.path.join(build, "centroids.npy"), centroids)
+        np.save(os.path.join(build, "list_ptr.npy"), list_ptr)
+        np.save(os.path.join(build, "list_rows.npy"), list_rows)
+    stopwatch.round("Clustering")
+    print(f"{len(store)} abstracts in {len(centroids)} lists")
+
+
+def get_vector_index() -> Optional[VectorIndex]:
+    """
+    :return: the index, opened on first use and again after a rebuild of it or of its
+        store, None if it or the embedding store has not been built
+    """
+    global _index, _built
+    # The compressed store, if built, replaces the float32 one
+    store = get_compressed_store() or get_embedding_store()
+    built = build_stamp(os.path.join(_INDEX_DIR, "list_rows.npy"))
+    if _built is not None and _built[0] is store and _built[1] == built:
+        return _index
+    with _lock:
+        if _built is None or _built[0] is not store or _built[1] != built:
+            _index = None if store is None else VectorIndex.open(store)
+            _built = (store, built)
+        return _index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the vector index over the embedding store"
+    )
+    parser.add_argument("--lists", type=int, default=4096)
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    store = EmbeddingStore.open()
+    if store is None:
+        raise SystemExit("Build the embedding store first")
+    build(store, _INDEX_DIR, args.lists, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+In-process store of the functional terms of a species.
+
+Every enrichment request used to pull the whole `FT` table and count all
+`TG` nodes from Neo4j. The store loads both once per species and keeps
+them as a sparse term x gene incidence matrix until it is refreshed
+explicitly (`POST /api/admin/refresh`) or the pathway data release changes.
+"""
+
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import threading
+from typing import Dict, Iterable, Iterator, Optional
+
+import database
+import neo4j
+import numpy as np
+import pandas as pd
+import queries
+import scipy.sparse as sp
+import workers
+from util.stopwatch import Stopwatch
+
+_SCRIPT_DIR = os.path.dirname(__file__)
+_RELEASE_FILE = os.path.join(
+    _SCRIPT_DIR, "pathway_data", "data", "release_versions.txt"
+)
+
+# Number of set bits of every byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+# Terms per chunk when counting bits, bounds the temporary memory
+_BITSET_CHUNK = 1024
+
+_stores: Dict[int, "TermStore"] = {}
+_lock = threading.Lock()
+# Every load gets a new generation, a reload of the same release included
+_generations = itertools.count()
+
+
+class TermStore:
+    """
+    Functional terms of one species
+
+    - `terms`: DataFrame with the columns id, clean, name and category, row `i`
+      describes term `i` of the incidence matrix
+    - `genes`: gene symbols, entry `j` describes column `j` of the incidence matrix
+    - `incidence`: sparse (terms x genes) matrix, 1 if the gene belongs to the term
+    - `gene_terms`: inverted index, the transposed incidence as (genes x terms) CSR
+    - `num_genes`: number of genes of the organism, the enrichment background
+    - `version`: data release the store was built from
+    - `generation`: number of the load, distinguishes reloads of the same release
+    - `bitsets`: the incidence as packed (terms x genes / 8) bitsets, built on first use
+    """
+
+    def __init__(
+        self,
+        species_id: int,
+        terms: pd.DataFrame,
+        genes: np.ndarray,
+        incidence: sp.csr_matrix,
+        num_genes: int,
+        version: str,
+    ):
+        self.species_id = species_id
+        self.terms = terms
+        self.genes = genes
+        self.incidence = incidence
+        self.num_genes = num_genes
+        self.version = version
+        self.generation = next(_generations)
+        self.gene_index = {gene: i for i, gene in enumerate(genes)}
+        self.term_index = {term: i for i, term in enumerate(terms["id"])}
+        self.term_sizes = np.diff(incidence.indptr).astype(np.int64)
+        self.gene_terms = incidence.T.tocsr()
+        self.gene_terms.sort_indices()
+        self._bitsets: Optional[np.ndarray] = None
+        # Blocks of `shared` in progress, the published arrays outlive the store until they end
+        self._shared_users = 0
+        self._retired = False
+        self._shared_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, driver: neo4j.Driver, species_id: int) -> "TermStore":
+        """
+        Build the store from the `FT` and `TG` nodes of a species.
+        """
+        stopwatch = Stopwatch()
+        version = release_version()
+        # Both queries are independent and run concurrently
+        async_driver = database.get_async_driver()
+        num_genes, terms = database.gather(
+            queries.get_number_of_genes_async(async_driver, species_id),
+            queries.get_enrichment_terms_async(async_driver, species_id),
+        )
+        df_terms = pd.DataFrame(terms)
+
+        # Lists are stored as strings, evaluate to lists using JSON.
+        gene_index: Dict[str, int] = {}
+        indptr = [0]
+        indices: list[int] = []
+        for value in df_terms["symbols"]:
+            symbols = json.loads(value.replace("'", '"')) if value else []
+            indices.extend(
+                {gene_index.setdefault(gene, len(gene_index)) for gene in symbols}
+            )
+            indptr.append(len(indices))
+
+        incidence = sp.csr_matrix(
+            (
+                np.ones(len(indices), dtype=np.int32),
+                np.asarray(indices, dtype=np.int32),
+                np.asarray(indptr, dtype=np.int64),
+            ),
+            shape=(len(df_terms), len(gene_index)),
+        )
+        incidence.sort_indices()
+        genes = np.array(list(gene_index), dtype=object)
+        terms = df_terms.drop(columns="symbols").reset_index(drop=True)
+
+        stopwatch.total("term_store_load")
+        return cls(species_id, terms, genes, incidence, num_genes, version)
+
+    def gene_indices(self, genes: Iterable[str]) -> np.ndarray:
+        """
+        :return: sorted column indices of the given genes, unknown genes are skipped
+        """
+        indices = {self.gene_index[gene] for gene in genes if gene in self.gene_index}
+        return np.fromiter(sorted(indices), dtype=np.int64, count=len(indices))
+
+    def candidate_terms(self, gene_idx: np.ndarray):
+        """
+        Terms that share at least one gene with the input, looked up through
+        the inverted index so that the cost depends on the input size only.
+
+        :return: term rows (sorted) and the size of their intersection with the input
+        """
+        return gather_terms(self.gene_terms.indptr, self.gene_terms.indices, gene_idx)
+
+    @property
+    def bitsets(self) -> np.ndarray:
+        if self._bitsets is None:
+            self._bitsets = pack_bits(
+                self.incidence.indptr, self.incidence.indices, len(self.genes)
+            )
+        return self._bitsets
+
+    def background_term_sizes(self, background: np.ndarray) -> np.ndarray:
+        """
+        :param background: packed bitset over the genes of the store, see `pack_bits`
+        :return: number of background genes of every term (AND plus popcount)
+        """
+        sizes = np.empty(len(self.terms), dtype=np.int64)
+        for start in range(0, len(self.terms), _BITSET_CHUNK):
+            chunk = self.bitsets[start : start + _BITSET_CHUNK] & background
+            sizes[start : start + _BITSET_CHUNK] = _POPCOUNT[chunk].sum(
+                axis=1, dtype=np.int64
+            )
+        return sizes
+
+    @contextlib.contextmanager
+    def shared(self) -> Iterator[dict]:
+        """
+        Handles of the inverted index and the term sizes for `workers.attach`, valid
+        until the block ends. The arrays are published on first use; a replaced
+        store passes the arrays themselves instead of publishing them again.
+        """
+        with self._shared_lock:
+            if self._retired:
+                published = False
+                handles = {
+                    "indptr": self.gene_terms.indptr,
+                    "indices": self.gene_terms.indices,
+                    "term_sizes": self.term_sizes,
+                }
+            else:
+                key = self._shared_key()
+                handles = {
+                    "indptr": workers.share(f"{key}-indptr", self.gene_terms.indptr),
+                    "indices": workers.share(f"{key}-indices", self.gene_terms.indices),
+                    "term_sizes": workers.share(f"{key}-sizes", self.term_sizes),
+                }
+                published = True
+                self._shared_users += 1
+        try:
+            yield handles
+        finally:
+            if published:
+                with self._shared_lock:
+                    self._shared_users -= 1
+                    unshare = self._retired and self._shared_users == 0
+                if unshare:
+                    self._unshare()
+
+    def retire(self):
+        """
+        Called once the store is replaced, the published arrays are removed as soon
+        as no block of `shared` uses them anymore.
+        """
+        with self._shared_lock:
+            self._retired = True
+            unshare = self._shared_users == 0
+        if unshare:
+            self._unshare()
+
+    def _unshare(self):
+        key = self._shared_key()
+        for name in ["indptr", "indices", "sizes"]:
+            workers.unshare(f"{key}-{name}")
+
+    def _shared_key(self) -> str:
+        return f"terms-{self.species_id}-{self.version}-{self.generation}"
+
+    def overlap_graph(self, term_ids: list[str], threshold: float = 0.5):
+        """
+        Terms connected by gene overlap, measured by the fraction of the
+        smaller term that is shared (same score as the `OVERLAP` relation).
+
+        :return: DataFrame with the columns source, target and score (in percent)
+        """
+        rows = np.array(
+            [self.term_index[term] for term in term_ids if term in self.term_index],
+            dtype=np.int64,
+        )
+        sub = self.incidence[rows]
+        intersection = sp.triu(sub @ sub.T, k=1).tocoo()
+        sizes = self.term_sizes[rows]
+        score = intersection.data / np.minimum(
+            sizes[intersection.row], sizes[intersection.col]
+        )
+        keep = score >= threshold
+        ids = self.terms["id"].to_numpy()[rows]
+        return pd.DataFrame(
+            {
+                "source": ids[intersection.row[keep]],
+                "target": ids[intersection.col[keep]],
+                "score": (np.round(score[keep], 2) * 100).astype(int),
+            }
+        )
+
+    def jaccard(self, rows: np.ndarray, threshold: float) -> sp.csr_matrix:
+        """
+        Pairwise Jaccard similarity of the gene sets of the given terms.
+
+        :param rows: term rows of the store
+        :param threshold: similarities below are dropped
+        :return: sparse symmetric (len(rows) x len(rows)) matrix without the diagonal
+        """
+        sub = self.incidence[rows]
+        intersection = (sub @ sub.T).tocoo()
+        sizes = self.term_sizes[rows]
+        union = sizes[intersection.row] + sizes[intersection.col] - intersection.data
+        score = intersection.data / np.maximum(union, 1)
+        keep = (score >= threshold) & (intersection.row != intersection.col)
+        return sp.csr_matrix(
+            (score[keep], (intersection.row[keep], intersection.col[keep])),
+            shape=(len(rows), len(rows)),
+        )
+
+
+def gather_terms(indptr: np.ndarray, indices: np.ndarray, gene_idx: np.ndarray):
+    """
+    Look up the terms of the given genes in the inverted (genes x terms) CSR index.
+
+    :return: term rows (sorted) and the number of given genes in each of them
+    """
+    starts, ends = indptr[gene_idx], indptr[gene_idx + 1]
+    lengths = ends - starts
+    # Concatenate the term lists of all input genes without a Python loop
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    positions = offsets + np.arange(lengths.sum())
+    return np.unique(indices[positions], return_counts=True)
+
+
+def pack_bits(indptr: np.ndarray, indices: np.ndarray, num_genes: int) -> np.ndarray:
+    """
+    Pack the rows of a CSR matrix into bitsets (same bit order as `np.packbits`).
+
+    :return: (rows x ceil(num_genes / 8)) uint8 array
+    """
+    bits = np.zeros((len(indptr) - 1, (num_genes + 7) // 8), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    np.bitwise_or.at(
+        bits, (rows, indices >> 3), (128 >> (indices & 7)).astype(np.uint8)
+    )
+    return bits
+
+
+def release_version() -> str:
+    """
+    :return: fingerprint of the pathway data release, empty if unknown
+    """
+    if not os.path.exists(_RELEASE_FILE):
+        return ""
+    with open(_RELEASE_FILE, "rb") as f:
+        return hashlib.sha1(f.read(), usedforsecurity=False).hexdigest()
+
+
+def get_term_store(driver: neo4j.Driver, species_id: int) -> TermStore:
+    """
+    :return: the term store of the species, loaded on first use or after a new data release
+    """
+    store = _stores.get(species_id)
+    if store is not None and store.version == release_version():
+        return store
+    with _lock:
+        store = _stores.get(species_id)
+        if store is None or store.version != release_version():
+            store = _replace(species_id, TermStore.load(driver, species_id))
+        return store
+
+
+def refresh(driver: neo4j.Driver, species_id: Optional[int] = None):
+    """
+    Reload the store of one species, or of every loaded species if `species_id` is None.
+    """
+    with _lock:
+        species = list(_stores) if species_id is None else [species_id]
+        for species_id in species:
+            _replace(species_id, TermStore.load(driver, species_id))
+
+
+def _replace(species_id: int, store: TermStore) -> TermStore:
+    """
+    Install a newly loaded store and retire the one it replaces.
+    """
+    previous = _stores.get(species_id)
+    _stores[species_id] = store
+    if previous is not None:
+        previous.retire()
+    return store
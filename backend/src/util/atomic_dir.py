@@ -0,0 +1,54 @@
+"""
+Atomic replacement of a directory of build outputs.
+"""
+
+import contextlib
+import os
+import shutil
+import tempfile
+from typing import Iterator, Optional, Tuple
+
+
+@contextlib.contextmanager
+def replace_directory(directory: str) -> Iterator[str]:
+    """
+    build into a temporary sibling of `directory` and swap it into place when the
+    block finishes without an error
+
+    files that running processes have memory-mapped are never rewritten, the old
+    directory is renamed away and removed, so existing mappings stay valid until
+    the readers reopen the new build
+
+    :return: path of the temporary directory to write the build to
+    """
+    directory = os.path.abspath(directory)
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    build = tempfile.mkdtemp(prefix=f".{os.path.basename(directory)}.", dir=parent)
+    os.chmod(build, 0o755)
+    try:
+        yield build
+    except BaseException:
+        shutil.rmtree(build, ignore_errors=True)
+        raise
+    old = f"{build}.old"
+    if os.path.exists(directory):
+        os.rename(directory, old)
+    os.rename(build, directory)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def build_stamp(path: str) -> Optional[Tuple[int, int]]:
+    """
+    inode and modification time of a file of the current build
+
+    a swapped-in build always changes the stamp, so comparing it tells whether an
+    opened build is still the current one
+
+    :return: the stamp, None if there is no build
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
@@ -0,0 +1,17 @@
+from typing import Iterable
+
+import numpy as np
+
+
+def sorted_rows(keys: np.ndarray, names: Iterable) -> np.ndarray:
+    """
+    look up names in a sorted array of string keys with a binary search
+
+    :param keys: sorted string keys, e.g. the memory-mapped ids of a store
+    :return: sorted rows of the given names, unknown names are skipped
+    """
+    values = np.asarray([str(name) for name in names], dtype=str)
+    positions = np.searchsorted(keys, values)
+    valid = positions < len(keys)
+    positions, values = positions[valid], values[valid]
+    return np.unique(positions[keys[positions] == values])
@@ -0,0 +1,181 @@
+"""
+Process-wide pool for CPU heavy work done while answering a request.
+
+The pool is started once at startup and is bounded: at most `max_workers`
+tasks run and at most `max_queue` further tasks wait, any other submission
+blocks until a slot is free. Large read-only arrays are published once as
+memory-mapped files on shared memory (`share`) and opened by path in the
+workers (`attach`) instead of being pickled with every task. A pool broken
+by a dying worker is replaced on the next submission.
+"""
+
+import atexit
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, Union
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Load .env file
+load_dotenv()
+
+_executor: Optional[ProcessPoolExecutor] = None
+_slots: Optional[threading.BoundedSemaphore] = None
+_shared_dir: Optional[str] = None
+_max_workers = 1
+_attached: dict[str, np.ndarray] = {}
+_restart_lock = threading.Lock()
+
+
+def start(max_workers: Optional[int] = None, max_queue: Optional[int] = None):
+    """
+    Start the pool, has to be called before the server starts handling requests
+    since the workers are forked from the calling process.
+
+    :param max_workers: number of worker processes (env `WORKER_POOL_SIZE`, default: number of cores)
+    :param max_queue: number of tasks that may wait for a worker (env `WORKER_QUEUE_SIZE`, default: 4 * max_workers)
+    """
+    global _executor, _slots, _shared_dir, _max_workers
+    if _executor is not None:
+        return
+    max_workers = max_workers or int(
+        os.getenv("WORKER_POOL_SIZE", str(os.cpu_count() or 1))
+    )
+    max_queue = max_queue or int(os.getenv("WORKER_QUEUE_SIZE", str(4 * max_workers)))
+
+    _shared_dir = tempfile.mkdtemp(
+        prefix="pgdb-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None
+    )
+    _max_workers = max_workers
+    _slots = threading.BoundedSemaphore(max_workers + max_queue)
+    _executor = ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("fork")
+    )
+    # Fork all workers now, while the process has no request threads yet
+    for future in [_executor.submit(os.getpid) for _ in range(max_workers)]:
+        future.result()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """
+    Stop the workers and remove the shared arrays.
+    """
+    global _executor, _slots, _shared_dir, _max_workers
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+    if _shared_dir is not None:
+        shutil.rmtree(_shared_dir, ignore_errors=True)
+    _executor, _slots, _shared_dir, _max_workers = None, None, None, 1
+
+
+def running() -> bool:
+    return _executor is not None
+
+
+def size() -> int:
+    """
+    :return: number of worker processes, 1 if the pool is not running
+    """
+    return _max_workers
+
+
+def submit(fn: Callable, *args, **kwargs) -> Future:
+    """
+    Run `fn(*args, **kwargs)` in the pool, blocks while the queue is full.
+    Without a running pool the function is executed right away in the calling process.
+
+    :return: future of the result
+    """
+    if _executor is None or _slots is None:
+        future: Future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    slots = _slots
+    slots.acquire()
+    executor = _executor
+    try:
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            future = _replace_broken(executor).submit(fn, *args, **kwargs)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def _replace_broken(broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+    """
+    Replace a pool that broke because a worker died. The server has request threads
+    by now, so the new workers are started by a fork server instead of forking this
+    process.
+
+    :return: the running pool
+    """
+    global _executor
+    with _restart_lock:
+        if _executor is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            _executor = ProcessPoolExecutor(
+                max_workers=_max_workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        if _executor is None:
+            raise RuntimeError("The worker pool has been shut down")
+        return _executor
+
+
+def share(key: str, array: np.ndarray) -> Union[str, np.ndarray]:
+    """
+    Publish a read-only array to the workers.
+
+    :param key: unique name of the array, e.g. including a data version
+    :return: a handle for `attach`, the array itself if the pool is not running
+    """
+    if _shared_dir is None:
+        return array
+    path = os.path.join(_shared_dir, f"{key}.npy")
+    if not os.path.exists(path):
+        tmp_path = os.path.join(_shared_dir, f"{key}.{threading.get_ident()}.tmp.npy")
+        np.save(tmp_path, np.ascontiguousarray(array))
+        os.replace(tmp_path, path)
+    return path
+
+
+def unshare(key: str):
+    """
+    Remove an array published by `share`. Workers drop their mapping of it the
+    next time they attach a new array.
+    """
+    if _shared_dir is None:
+        return
+    try:
+        os.remove(os.path.join(_shared_dir, f"{key}.npy"))
+    except FileNotFoundError:
+        pass
+
+
+def attach(handle: Union[str, np.ndarray]) -> np.ndarray:
+    """
+    :return: the array behind a handle of `share`, memory-mapped without copying
+    """
+    if isinstance(handle, np.ndarray):
+        return handle
+    if handle not in _attached:
+        # Release the mappings of removed arrays before mapping a new one
+        for path in [path for path in _attached if not os.path.exists(path)]:
+            del _attached[path]
+        _attached[handle] = np.load(handle, mmap_mode="r")
+    return _attached[handle]
@@ -0,0 +1,10 @@
+"""
+Unit tests of the backend, run from the repository root with
+`make test-backend`.
+"""
+
+import os
+import sys
+
+# The backend modules import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -0,0 +1,47 @@
+import tempfile
+import unittest
+
+import numpy as np
+from summarization.compression import compress
+from summarization.embedding_store import EmbeddingStore
+
+
+class TestQuantization(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((500, 64)).astype(np.float32)
+        self.store = EmbeddingStore(
+            np.array([f"{pmid:08d}" for pmid in range(500)]),
+            embeddings,
+            np.linalg.norm(embeddings, axis=1).astype(np.float32),
+        )
+        self.query = rng.standard_normal(64).astype(np.float32)
+        self.rows = np.arange(0, 500, 3)
+        self.exact = self.store.scores(self.query, self.rows)
+
+    def compressed_scores(self, dtype, dimension=None):
+        with tempfile.TemporaryDirectory() as directory:
+            compressed = compress(self.store, directory, dtype, dimension, sample=500)
+            scores = np.array(compressed.scores(self.query, self.rows))
+            codes = np.array(compressed.codes)
+            del compressed
+        return scores, codes
+
+    def test_float16(self):
+        scores, codes = self.compressed_scores("float16")
+        self.assertEqual(codes.dtype, np.float16)
+        np.testing.assert_allclose(scores, self.exact, atol=2e-3)
+
+    def test_int8(self):
+        scores, codes = self.compressed_scores("int8")
+        self.assertEqual(codes.dtype, np.int8)
+        # One quantization step per dimension is about (max - min) / 255
+        np.testing.assert_allclose(scores, self.exact, atol=2e-2)
+
+    def test_projection_keeps_the_ranking(self):
+        scores, _ = self.compressed_scores("float16", dimension=63)
+        self.assertGreater(np.corrcoef(scores, self.exact)[0, 1], 0.95)
+
+
+if __name__ == "__main__":
+    unittest.main()
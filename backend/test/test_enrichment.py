@@ -0,0 +1,330 @@
+import math
+import unittest
+from unittest import mock
+
+import enrichment
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import term_store
+from enrichment import benjamini_hochberg, hypergeometric_pvalues, running_sum_scores
+from util.lru_cache import LRUCache
+
+
+def hypergeometric_upper_tail(k, total, term, drawn):
+    """P(X >= k) by summing the probability mass function with exact integers"""
+    denominator = math.comb(total, drawn)
+    return (
+        sum(
+            math.comb(term, i) * math.comb(total - term, drawn - i)
+            for i in range(k, min(term, drawn) + 1)
+        )
+        / denominator
+    )
+
+
+def benjamini_hochberg_reference(p_values, n_tests):
+    order = sorted(range(len(p_values)), key=lambda i: p_values[i])
+    fdr = [0.0] * len(p_values)
+    previous = 1.0
+    for rank in range(len(order), 0, -1):
+        i = order[rank - 1]
+        previous = min(previous, p_values[i] * n_tests / rank)
+        fdr[i] = previous
+    return fdr
+
+
+def running_sum_reference(hits, weights, num_ranked):
+    """ES of one term by walking the whole ranked list"""
+    total = sum(weights[p] for p in hits) or 1.0
+    miss_cost = 1.0 / max(num_ranked - len(hits), 1)
+    running, es_max, es_min = 0.0, 0.0, 0.0
+    for position in range(num_ranked):
+        if position in hits:
+            running += weights[position] / total
+        else:
+            running -= miss_cost
+        es_max, es_min = max(es_max, running), min(es_min, running)
+    return es_max if es_max >= -es_min else es_min
+
+
+def make_store(incidence=None) -> term_store.TermStore:
+    """80 terms over 150 genes, random unless the incidence is given, the genes
+    are the whole background"""
+    if incidence is None:
+        incidence = sp.random(80, 150, density=0.1, random_state=0, format="csr")
+    incidence.data[:] = 1
+    incidence = incidence.astype(np.int32)
+    incidence.sort_indices()
+    terms = pd.DataFrame(
+        {"id": [f"T{i}" for i in range(80)], "clean": "", "name": "", "category": "c"}
+    )
+    genes = np.array([f"G{i}" for i in range(150)], dtype=object)
+    return term_store.TermStore(9606, terms, genes, incidence, 150, "release")
+
+
+class EnrichmentTestCase(unittest.TestCase):
+    """Runs the enrichment against a stub term store and without the result cache,
+    so every call computes its table from scratch"""
+
+    def setUp(self):
+        self.store = self.make_store()
+        for patcher in [
+            mock.patch.object(term_store, "get_term_store", return_value=self.store),
+            mock.patch.object(enrichment, "result_cache", LRUCache(maxsize=0)),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_store(self) -> term_store.TermStore:
+        return make_store()
+
+    def genes(self, terms, extra=()) -> list[str]:
+        """Genes of some terms plus extra gene columns, enriched in those terms"""
+        columns = set(extra)
+        for term in terms:
+            row = self.store.incidence[term]
+            columns.update(row.indices.tolist())
+        return [f"g{column}" for column in sorted(columns)]
+
+    def enrich(self, genes, **kwargs) -> pd.DataFrame:
+        return enrichment.functional_enrichment(None, genes, 9606, {}, {}, **kwargs)
+
+    def assertSameTable(self, table, expected):
+        self.assertGreater(len(expected), 0)
+        pd.testing.assert_frame_equal(table, expected)
+
+
+class TestHypergeometric(unittest.TestCase):
+    def test_upper_tail(self):
+        # (intersection, background, term genes, input genes)
+        cases = [(0, 50, 10, 5), (1, 50, 10, 5), (3, 50, 10, 5), (5, 60, 5, 5)]
+        cases += [(2, 1000, 40, 30), (7, 20000, 200, 150), (12, 20000, 15, 300)]
+        for k, total, term, drawn in cases:
+            p_value = hypergeometric_pvalues([k], total, [term], drawn)[0]
+            expected = hypergeometric_upper_tail(k, total, term, drawn)
+            self.assertAlmostEqual(p_value / expected, 1.0, places=9)
+
+    def test_no_intersection_is_one(self):
+        p_values = hypergeometric_pvalues([0, 0], 100, [5, 50], 10)
+        np.testing.assert_allclose(p_values, [1.0, 1.0])
+
+
+class TestBenjaminiHochberg(unittest.TestCase):
+    def test_matches_reference(self):
+        rng = np.random.default_rng(0)
+        p_values = rng.random(50) ** 3
+        p_values[[3, 7]] = p_values[11]  # ties
+        for n_tests in [None, 50, 200]:
+            expected = benjamini_hochberg_reference(list(p_values), n_tests or 50)
+            np.testing.assert_allclose(
+                benjamini_hochberg(p_values, n_tests=n_tests), expected
+            )
+
+    def test_capped_at_one(self):
+        self.assertTrue(np.all(benjamini_hochberg([0.5, 0.9], n_tests=100) <= 1.0))
+
+
+class TestBatchEnrichment(EnrichmentTestCase):
+    def test_matches_single_lists(self):
+        gene_lists = [
+            self.genes([0, 1]),
+            self.genes([5], extra=[3, 4, 100]),
+            self.genes([10, 11, 12]) + ["unknown"],
+        ]
+        tables = enrichment.functional_enrichment_batch(None, gene_lists, 9606, {}, {})
+        self.assertEqual(len(tables), len(gene_lists))
+        for table, genes in zip(tables, gene_lists):
+            self.assertSameTable(table, self.enrich(genes))
+
+
+class TestSessionEnrichment(EnrichmentTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(enrichment, "session_states", LRUCache(8))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_edits_match_enrichment_from_scratch(self):
+        genes = self.genes([0, 1, 2])
+        edits = [
+            genes + ["g149", "g148"],  # added
+            genes[3:] + ["g149"],  # removed
+            genes[3:-2] + ["g7", "g8", "unknown"],  # both, and an unknown gene
+            self.genes([40, 41]),  # replaced, counted again
+        ]
+        self.enrich(genes, session_id="s")
+        for edited in edits:
+            with mock.patch.object(
+                self.store, "candidate_terms", wraps=self.store.candidate_terms
+            ) as candidate_terms:
+                table = self.enrich(edited, session_id="s")
+            if edited is not edits[-1]:
+                # Only the added and removed genes are looked up
+                looked_up = sum(
+                    len(call.args[0]) for call in candidate_terms.mock_calls
+                )
+                self.assertLess(looked_up, len(edited))
+            self.assertSameTable(table, self.enrich(edited))
+
+
+class TestRunningSumScores(unittest.TestCase):
+    def test_matches_reference(self):
+        rng = np.random.default_rng(1)
+        num_ranked = 40
+        weights = np.abs(rng.standard_normal(num_ranked))
+        terms = [
+            sorted(rng.choice(num_ranked, size, replace=False).tolist())
+            for size in [1, 3, 8, 20, 39]
+        ]
+        terms += [[0, 1, 2, 3], [36, 37, 38, 39]]
+        positions = np.concatenate(terms)
+        term_ptr = np.concatenate(([0], np.cumsum([len(t) for t in terms])))
+        es = running_sum_scores(positions, weights[positions], term_ptr, num_ranked)
+        expected = [running_sum_reference(set(t), weights, num_ranked) for t in terms]
+        np.testing.assert_allclose(es, expected, atol=1e-12)
+
+
+class TestPrerankedEnrichment(EnrichmentTestCase):
+    def preranked(self, genes, scores, **kwargs) -> pd.DataFrame:
+        return enrichment.preranked_enrichment(
+            None, genes, scores, 9606, {}, {}, **kwargs
+        )
+
+    def test_rejects_invalid_input(self):
+        genes = self.genes([0])
+        scores = list(range(len(genes)))
+        for num_permutations in [0, -1]:
+            with self.assertRaises(ValueError):
+                self.preranked(genes, scores, num_permutations=num_permutations)
+        with self.assertRaises(ValueError):
+            self.preranked(genes, scores[1:])
+
+    def test_enrichment_scores_match_reference(self):
+        # Genes of term 0 on top, all other genes below
+        genes = self.genes([0])
+        genes += [gene for gene in self.genes(range(80)) if gene not in genes]
+        scores = np.linspace(3.0, -1.0, len(genes)).tolist()
+        table = self.preranked(genes, scores, num_permutations=200, min_size=1)
+        self.assertIn("T0", table["id"].tolist())
+
+        weights = np.abs(scores)
+        for term, es in zip(table["id"], table["es"]):
+            columns = self.store.incidence[int(term[1:])].indices
+            hits = {genes.index(f"g{column}") for column in columns}
+            self.assertAlmostEqual(
+                es, running_sum_reference(hits, weights, len(genes)), places=12
+            )
+
+
+class TestBackgroundEnrichment(EnrichmentTestCase):
+    def test_whole_organism_background(self):
+        genes = self.genes([0, 1, 2])
+        background = [f"G{column}" for column in range(150)]
+        self.assertSameTable(
+            self.enrich(genes, background=background), self.enrich(genes)
+        )
+
+    def test_matches_reference(self):
+        genes = self.genes([0, 1], extra=[140, 141]) + ["unknown"]
+        background = genes[::2] + self.genes([], extra=range(0, 150, 2))
+        background += ["unmeasured", "unknown"]
+        table = self.enrich(genes, background=background)
+
+        # Only input and term genes within the background are counted
+        background_set = {gene.upper() for gene in background}
+        in_background = {gene.upper() for gene in genes} & background_set
+        reference = []
+        for term, row in enumerate(self.store.incidence):
+            term_genes = set(self.store.genes[row.indices]) & background_set
+            if term_genes:
+                reference.append(
+                    (
+                        f"T{term}",
+                        hypergeometric_upper_tail(
+                            len(term_genes & in_background),
+                            len(background_set),
+                            len(term_genes),
+                            len(in_background),
+                        ),
+                    )
+                )
+        fdr = benjamini_hochberg_reference([p for _, p in reference], len(reference))
+        expected = {
+            term: (p_value, fdr_rate)
+            for (term, p_value), fdr_rate in zip(reference, fdr)
+            if fdr_rate < 0.05
+        }
+
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(set(table["id"]), set(expected))
+        for term, p_value, fdr_rate in zip(
+            table["id"], table["p_value"], table["fdr_rate"]
+        ):
+            self.assertAlmostEqual(p_value / expected[term][0], 1.0, places=9)
+            self.assertAlmostEqual(fdr_rate / expected[term][1], 1.0, places=9)
+
+
+class TestReduceRedundancy(EnrichmentTestCase):
+    def make_store(self) -> term_store.TermStore:
+        # Overlapping terms of four modules of 15 genes, then random terms
+        rng = np.random.default_rng(2)
+        rows = [
+            np.union1d(
+                rng.choice(np.arange(15 * module, 15 * module + 15), 11, replace=False),
+                rng.choice(150, 2),
+            )
+            for module in range(4)
+            for _ in range(6)
+        ]
+        rows += [rng.choice(150, 15, replace=False) for _ in range(80 - len(rows))]
+        incidence = sp.csr_matrix(
+            (
+                np.ones(sum(len(row) for row in rows)),
+                np.concatenate(rows),
+                np.concatenate(([0], np.cumsum([len(row) for row in rows]))),
+            ),
+            shape=(80, 150),
+        )
+        return make_store(incidence)
+
+    def reference(self, table, threshold) -> pd.DataFrame:
+        """Greedy clustering with the Jaccard similarity of python sets"""
+        gene_sets = {
+            term: set(self.store.incidence[int(term[1:])].indices)
+            for term in table["id"]
+        }
+        order = sorted(range(len(table)), key=lambda i: table["p_value"][i])
+        clusters = {}
+        clustered = set()
+        for i in order:
+            if i in clustered:
+                continue
+            representative = gene_sets[table["id"][i]]
+            clusters[i] = [
+                j
+                for j in order
+                if j == i
+                or j not in clustered
+                and len(representative & gene_sets[table["id"][j]])
+                >= threshold * len(representative | gene_sets[table["id"][j]])
+            ]
+            clustered.update(clusters[i])
+        expected = table.iloc[sorted(clusters)].copy()
+        expected["cluster_members"] = [
+            [table["id"][j] for j in clusters[i]] for i in sorted(clusters)
+        ]
+        expected["cluster_size"] = [len(clusters[i]) for i in sorted(clusters)]
+        return expected.reset_index(drop=True)
+
+    def test_matches_reference(self):
+        table = self.enrich(self.genes([], extra=range(45)))
+        self.assertGreater(len(table), 5)
+        for threshold in [0.1, 0.2, 0.5, 1.0]:
+            reduced = enrichment.reduce_redundancy(None, table, 9606, threshold)
+            self.assertSameTable(reduced, self.reference(table, threshold))
+            self.assertEqual(reduced["cluster_size"].sum(), len(table))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import string_graph
+from string_graph import StringGraph
+
+
+class TestInducedEdges(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        ids = np.array([f"P{i:03d}" for i in range(40)], dtype=object)
+        pairs = {tuple(rng.choice(40, 2, replace=False)) for _ in range(300)}
+        source, target = (np.array(column) for column in zip(*sorted(pairs)))
+        self.edges = [
+            (ids[s], ids[t], int(score), int(combined))
+            for s, t, score, combined in zip(
+                source,
+                target,
+                rng.integers(0, 1000, len(source)),
+                rng.integers(0, 1000, len(source)),
+            )
+        ]
+        columns = list(zip(*self.edges))
+        self.graph = StringGraph.build(
+            np.array(columns[0], dtype=object),
+            np.array(columns[1], dtype=object),
+            np.array(columns[2]),
+            np.array(columns[3]),
+            "test",
+        )
+
+    def induced(self, protein_ids, threshold, combined):
+        source, target, score = self.graph.induced_edges(
+            protein_ids, threshold, combined
+        )
+        return sorted(zip(source.tolist(), target.tolist(), score.tolist()))
+
+    def test_matches_brute_force(self):
+        protein_ids = [f"P{i:03d}" for i in range(0, 40, 2)] + ["unknown", "P002"]
+        for threshold in [0, 400, 900]:
+            for combined in [False, True]:
+                column = 3 if combined else 2
+                expected = sorted(
+                    (edge[0], edge[1], edge[column])
+                    for edge in self.edges
+                    if edge[0] in protein_ids
+                    and edge[1] in protein_ids
+                    and edge[column] >= threshold
+                )
+                self.assertEqual(
+                    self.induced(protein_ids, threshold, combined), expected
+                )
+
+    def test_unknown_proteins(self):
+        self.assertEqual(self.induced(["unknown"], 0, False), [])
+
+
+class TestRebuild(unittest.TestCase):
+    def build(self, score):
+        return StringGraph.build(
+            np.array(["A", "B"], dtype=object),
+            np.array(["B", "C"], dtype=object),
+            np.array([score, score]),
+            np.array([score, score]),
+            string_graph.release_version(),
+        )
+
+    def test_rebuild_keeps_open_mappings_and_is_picked_up(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            string_graph, "_GRAPH_DIR", directory
+        ), mock.patch.dict(string_graph._graphs, clear=True):
+            self.assertIsNone(string_graph.get_string_graph(1))
+            self.build(100).save(os.path.join(directory, "1"))
+            old = string_graph.get_string_graph(1)
+            self.assertEqual(old.score.tolist(), [100, 100])
+
+            self.build(200).save(os.path.join(directory, "1"))
+            # The old mapping still reads the old build, the next lookup the new one
+            self.assertEqual(old.score.tolist(), [100, 100])
+            self.assertEqual(
+                string_graph.get_string_graph(1).score.tolist(), [200, 200]
+            )
+            self.assertEqual(os.listdir(directory), ["1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
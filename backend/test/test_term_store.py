@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+from term_store import gather_terms, pack_bits
+
+
+def random_incidence(seed, terms=60, genes=203, density=0.08) -> sp.csr_matrix:
+    incidence = sp.random(
+        terms, genes, density=density, random_state=seed, format="csr"
+    )
+    incidence.data[:] = 1
+    incidence.sort_indices()
+    return incidence
+
+
+class TestGatherTerms(unittest.TestCase):
+    def test_matches_set_intersection(self):
+        incidence = random_incidence(0)
+        gene_terms = incidence.T.tocsr()
+        gene_terms.sort_indices()
+        term_genes = [set(row.indices) for row in incidence]
+        for gene_idx in [
+            np.array([], dtype=np.int64),
+            np.array([5]),
+            np.arange(0, 203, 3),
+        ]:
+            terms, counts = gather_terms(
+                gene_terms.indptr, gene_terms.indices, gene_idx
+            )
+            expected = {
+                term: len(genes & set(gene_idx.tolist()))
+                for term, genes in enumerate(term_genes)
+                if genes & set(gene_idx.tolist())
+            }
+            self.assertEqual(dict(zip(terms.tolist(), counts.tolist())), expected)
+
+
+class TestPackBits(unittest.TestCase):
+    def test_matches_packbits(self):
+        # 203 genes, the last byte of every row is only partly used
+        incidence = random_incidence(1)
+        bits = pack_bits(incidence.indptr, incidence.indices, incidence.shape[1])
+        expected = np.packbits(incidence.toarray().astype(bool), axis=1)
+        np.testing.assert_array_equal(bits, expected)
+
+    def test_empty_rows(self):
+        bits = pack_bits(np.array([0, 0, 2]), np.array([0, 9]), 10)
+        np.testing.assert_array_equal(bits, [[0, 0], [128, 64]])
+
+
+if __name__ == "__main__":
+    unittest.main()
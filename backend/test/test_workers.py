@@ -0,0 +1,76 @@
+import os
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import term_store
+import workers
+from enrichment import _score_candidates
+
+
+def make_store(seed: int) -> term_store.TermStore:
+    incidence = sp.random(80, 150, density=0.05, random_state=seed, format="csr")
+    incidence.data[:] = 1
+    incidence = incidence.astype(np.int32)
+    terms = pd.DataFrame(
+        {"id": [f"T{i}" for i in range(80)], "clean": "", "name": "", "category": "c"}
+    )
+    genes = np.array([f"G{i}" for i in range(150)], dtype=object)
+    return term_store.TermStore(10090, terms, genes, incidence, 20000, "release")
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        workers.start(max_workers=2)
+        self.addCleanup(workers.shutdown)
+
+    def score(self, store, gene_idx):
+        with store.shared() as shared:
+            return workers.submit(
+                _score_candidates, shared, gene_idx, 20000, len(gene_idx), 80
+            ).result()
+
+    def test_reload_of_the_same_release(self):
+        gene_idx = np.arange(0, 150, 4)
+        self.addCleanup(term_store._stores.pop, 10090, None)
+        for seed in [1, 2]:
+            store = make_store(seed)
+            term_store._replace(10090, store)
+            reference = _score_candidates(
+                {
+                    "indptr": store.gene_terms.indptr,
+                    "indices": store.gene_terms.indices,
+                    "term_sizes": store.term_sizes,
+                },
+                gene_idx,
+                20000,
+                len(gene_idx),
+                80,
+            )
+            for pooled, expected in zip(self.score(store, gene_idx), reference):
+                np.testing.assert_array_equal(pooled, expected)
+
+    def test_arrays_outlive_a_replaced_store_in_use(self):
+        old, new = make_store(1), make_store(2)
+        with old.shared() as shared:
+            old.retire()
+            # Still in use, the published arrays stay
+            self.assertTrue(all(os.path.exists(path) for path in shared.values()))
+            workers.submit(workers.attach, shared["indptr"]).result()
+        self.assertFalse(any(os.path.exists(path) for path in shared.values()))
+        # A replaced store passes its arrays instead of publishing them again
+        with old.shared() as shared:
+            self.assertTrue(all(isinstance(a, np.ndarray) for a in shared.values()))
+        self.assertEqual(os.listdir(workers._shared_dir), [])
+        self.score(new, np.arange(10))
+
+    def test_pool_survives_a_dying_worker(self):
+        with self.assertRaises(BrokenProcessPool):
+            workers.submit(os._exit, 1).result()
+        self.assertNotEqual(workers.submit(os.getpid).result(), os.getpid())
+
+
+if __name__ == "__main__":
+    unittest.main()